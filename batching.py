@@ -0,0 +1,74 @@
+"""
+Микро-батчинг сообщений для LLM.
+
+Сообщения, пришедшие в течение короткого окна (в том числе из разных чатов), собираются
+в один запрос (Editor.extract_tasks_from_chat_messages), а результаты раздаются обратно
+ожидающим обработчикам.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBatcher:
+    """
+    process_batch получает список текстов и возвращает список результатов той же длины.
+    Пакет отправляется, как только набралось max_batch_size сообщений или с момента
+    первого сообщения в пакете прошло max_delay секунд.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[list[str]], Awaitable[list[Any]]],
+        max_batch_size: int = 10,
+        max_delay: float = 0.5,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, text: str) -> Any:
+        """Ставит сообщение в текущий пакет и ждёт результата по нему."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        # Держим ссылку на задачу, чтобы её не собрал сборщик мусора
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        texts = [text for text, _ in batch]
+        logger.info("LLM-пакет: %s сообщений в одном запросе", len(texts))
+        try:
+            results = await self.process_batch(texts)
+            if len(results) != len(batch):
+                raise RuntimeError(
+                    f"Ожидалось {len(batch)} результатов пакета, получено {len(results)}"
+                )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,490 @@
+"""
+Офлайн-бенчмарк бота без сети: Google Sheets и LLM заменены локальными заглушками.
+
+FakeGspreadClient — таблица в памяти с задержкой на каждый запрос и долей ошибок 429 (квота);
+FakeLLM — «эндпоинт» OpenAI, который отвечает синтетически по виду промпта или повторяет
+записанные ответы (--replay: JSON-список строк-ответов, выдаются по кругу).
+
+Сценарии:
+  editor — потоки Editor на большой таблице: чтение зеркала, вставка, очередь вставок,
+           поиск задачи для изменения и само изменение;
+  bot    — поток сообщений в bot.on_group_message (по умолчанию 100 сообщений в секунду).
+Отчёт: пропускная способность, p50/p99 задержки по операциям и число запросов к API.
+
+Запуск: python benchmark.py [--scenario all|editor|bot] [--rows 10000] [--rate 100] [--seconds 5]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+SPREADSHEET_ID = "benchmark"
+CHAT_ID = -100500
+HEADERS = ["№", "Статус", "Задача", "Категория", "Ответственный", "Дата постановки", "Срок", "Приоритет", "Комментарии / Подзадачи"]
+NAMES = ["Петров", "Иванова", "Сидоров", "Егоров", "Смирнова", "Кузнецов"]
+WORKS = ["подготовить отчёт", "проверить смету", "согласовать макет", "заказать материалы", "созвониться с подрядчиком", "обновить график"]
+CHATTER = ["ок, спасибо", "принято", "кто сегодня на объекте?", "отлично, договорились", "фото прислал в общий чат", "понял"]
+
+
+def _col_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+class FakeBackend:
+    """Общие для всех листов задержка, ошибки квоты и счётчики запросов."""
+
+    def __init__(self, latency: float = 0.0, quota_error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.calls: Counter[str] = Counter()
+        self.quota_errors = 0
+        # Номер версии файла: растёт при каждой записи (для проверки версии через «Drive API»)
+        self.version = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, method: str) -> None:
+        with self._lock:
+            self.calls[method] += 1
+            fail = self._random.random() < self.quota_error_rate
+            if fail:
+                self.quota_errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise _quota_error()
+
+
+class _QuotaResponse:
+    status_code = 429
+    text = '{"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}'
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _quota_error():
+    import gspread
+
+    return gspread.exceptions.APIError(_QuotaResponse())
+
+
+class FakeWorksheet:
+    """Лист в памяти: только те методы gspread, которыми пользуется Editor."""
+
+    def __init__(self, backend: FakeBackend, title: str = "Лист1", sheet_id: int = 0):
+        self.backend = backend
+        self.title = title
+        self.id = sheet_id
+        self.cells: dict[tuple[int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def _bounds(self, range_name: str) -> tuple[int, int, int, int]:
+        match = re.fullmatch(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?", range_name.split("!")[-1])
+        first_col, first_row, last_col, last_row = match.groups()
+        last_col = last_col or first_col
+        if last_row:
+            last_row = int(last_row)
+        elif match.group(3):
+            last_row = max((row for row, _ in self.cells), default=0)
+        else:
+            last_row = int(first_row)
+        return _col_number(first_col), int(first_row), _col_number(last_col), last_row
+
+    def _read(self, range_name: str) -> list[list[str]]:
+        first_col, first_row, last_col, last_row = self._bounds(range_name)
+        result = []
+        for row in range(first_row, last_row + 1):
+            values = [self.cells.get((row, col), "") for col in range(first_col, last_col + 1)]
+            while values and values[-1] == "":
+                values.pop()
+            result.append(values)
+        while result and not result[-1]:
+            result.pop()
+        return result
+
+    def _write(self, range_name: str, values: list[list]) -> None:
+        self.backend.version += 1
+        first_col, first_row, _, _ = self._bounds(range_name)
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                self.cells[(first_row + i, first_col + j)] = "" if value is None else str(value)
+
+    def get(self, range_name: str, **kwargs):
+        self.backend.call("get")
+        with self._lock:
+            return self._read(range_name)
+
+    def batch_get(self, ranges: list[str], **kwargs):
+        self.backend.call("batch_get")
+        with self._lock:
+            return [self._read(range_name) for range_name in ranges]
+
+    def col_values(self, col: int, **kwargs):
+        self.backend.call("col_values")
+        with self._lock:
+            last_row = max((row for (row, c), v in self.cells.items() if c == col and v), default=0)
+            return [self.cells.get((row, col), "") for row in range(1, last_row + 1)]
+
+    def update(self, range_name: str, values: list[list], **kwargs):
+        self.backend.call("update")
+        with self._lock:
+            self._write(range_name, values)
+
+    def batch_update(self, data: list[dict], **kwargs):
+        self.backend.call("batch_update")
+        with self._lock:
+            for item in data:
+                self._write(item["range"], item["values"])
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend: FakeBackend, worksheets: list[FakeWorksheet]):
+        self.backend = backend
+        self._worksheets = worksheets
+
+    def worksheets(self):
+        self.backend.call("worksheets")
+        return list(self._worksheets)
+
+    def values_batch_get(self, ranges: list[str], params=None):
+        self.backend.call("values_batch_get")
+        by_title = {ws.title: ws for ws in self._worksheets}
+        value_ranges = []
+        for range_name in ranges:
+            title, _, cells = range_name.rpartition("!")
+            ws = by_title[title.strip("'").replace("''", "'")]
+            with ws._lock:
+                value_ranges.append({"range": range_name, "values": ws._read(cells)})
+        return {"valueRanges": value_ranges}
+
+    def get_lastUpdateTime(self):
+        self.backend.call("get_lastUpdateTime")
+        return str(self.backend.version)
+
+
+class FakeGspreadClient:
+    def __init__(self, backend: FakeBackend, spreadsheets: dict[str, FakeSpreadsheet]):
+        self.backend = backend
+        self.spreadsheets = spreadsheets
+
+    def open_by_key(self, key: str):
+        self.backend.call("open_by_key")
+        return self.spreadsheets[key]
+
+
+def make_spreadsheet(backend: FakeBackend, rows: int, seed: int = 0) -> FakeSpreadsheet:
+    """Лист с заголовком в 3-й строке и rows задачами ниже."""
+    rng = random.Random(seed)
+    sheet = FakeWorksheet(backend)
+    for j, header in enumerate(HEADERS):
+        sheet.cells[(3, 2 + j)] = header
+    for i in range(rows):
+        row = 4 + i
+        values = [
+            str(i + 1),
+            rng.choice(["🔄", "✅", "⚠️"]),
+            f"{rng.choice(WORKS).capitalize()} №{i + 1}",
+            rng.choice(["Электрика", "Отделка", "Закупки", ""]),
+            rng.choice(NAMES),
+            "01.09.2026 10:00",
+            f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2026",
+            rng.choice(["высокий", "средний", "низкий", ""]),
+            "",
+        ]
+        for j, value in enumerate(values):
+            sheet.cells[(row, 2 + j)] = value
+    return FakeSpreadsheet(backend, [sheet])
+
+
+class FakeLLM:
+    """
+    Заглушка клиента OpenAI: client.chat.completions.create(...) с задержкой latency.
+    Без replay отвечает синтетически по виду промпта (задача — сообщение, начинающееся с имени
+    из NAMES); с replay — выдаёт записанные ответы по кругу.
+    """
+
+    def __init__(self, latency: float = 0.0, replay: list[str] | None = None):
+        self.latency = latency
+        self.replay = replay
+        self.calls: Counter[str] = Counter()
+        self._replay_index = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model: str, messages: list[dict], **kwargs):
+        prompt = messages[-1]["content"]
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.replay:
+                content = self.replay[self._replay_index % len(self.replay)]
+                self._replay_index += 1
+                kind = "replay"
+            else:
+                kind, content = self._synthesize(prompt)
+            self.calls[kind] += 1
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=usage,
+        )
+
+    @staticmethod
+    def _task_answer(text: str) -> dict:
+        name = text.split(",")[0].strip()
+        if name not in NAMES:
+            return {"is_task": False}
+        match = re.search(r"\d{2}\.\d{2}\.\d{4}", text)
+        return {
+            "is_task": True,
+            "task": text.split(",", 1)[1].split(" к ")[0].strip().capitalize(),
+            "responsible": name,
+            "deadline": match.group(0) if match else None,
+            "priority": None,
+            "category": None,
+            "comments": None,
+        }
+
+    def _synthesize(self, prompt: str) -> tuple[str, str]:
+        if "Сообщения из рабочих чатов" in prompt:
+            items = json.loads(prompt.split("сообщения не связаны между собой):\n", 1)[1].split("\n\n", 1)[0])
+            answer = [{"id": item["id"], **self._task_answer(item["text"])} for item in items]
+            return "extract_batch", json.dumps(answer, ensure_ascii=False)
+        if "Сообщение в рабочем чате" in prompt:
+            text = prompt.split("«", 1)[1].split("»", 1)[0]
+            return "extract", json.dumps(self._task_answer(text), ensure_ascii=False)
+        if "Ранее пользователь поставил задачу" in prompt:
+            return "follow_up", json.dumps({"action": "unclear"})
+        if "Пользователь написал" in prompt:
+            rows = re.findall(r'"sheet_row": ?(\d+)', prompt) or re.findall(r"^(\d+)\t", prompt, re.M)
+            answer = {
+                "matched_rows": [int(rows[0])] if rows else [],
+                "changes": {"Статус": "✅"},
+                "Ответ в чате": "Поменял статус",
+            }
+            return "search", json.dumps(answer, ensure_ascii=False)
+        return "other", json.dumps({"task": "Задача", "responsible": None, "deadline": None})
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _summary(latencies: list[float], elapsed: float) -> dict:
+    return {
+        "count": len(latencies),
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+def _timed_ops(func, count: int) -> dict:
+    latencies = []
+    started_at = time.perf_counter()
+    for i in range(count):
+        op_started_at = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - op_started_at)
+    return _summary(latencies, time.perf_counter() - started_at)
+
+
+def _message(rng: random.Random, i: int, task_share: float) -> str:
+    if rng.random() < task_share:
+        deadline = f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2026"
+        return f"{rng.choice(NAMES)}, {rng.choice(WORKS)} по объекту {i} к {deadline}"
+    return rng.choice(CHATTER)
+
+
+def run_editor_scenario(args) -> dict:
+    from script import Editor
+
+    backend = FakeBackend(args.sheets_latency, args.quota_error_rate, args.seed)
+    client = FakeGspreadClient(backend, {SPREADSHEET_ID: make_spreadsheet(backend, args.rows, args.seed)})
+    llm = FakeLLM(args.llm_latency, args.replay)
+    queue_path = os.path.join(args.workdir, "editor_queue.json")
+    editor = Editor("benchmark", SPREADSHEET_ID, cache_ttl=args.cache_ttl, queue_path=queue_path, gspread_client=client)
+    rng = random.Random(args.seed)
+    ops = args.ops
+    task = lambda i: {"task": f"Бенчмарк {i}", "responsible": rng.choice(NAMES), "deadline": "01.12.2026"}
+
+    results = {}
+    results["mirror_load"] = _timed_ops(lambda i: (editor.invalidate_cache(), editor.get_last_filled_row()), 3)
+    results["get_last_filled_row"] = _timed_ops(lambda i: editor.get_last_filled_row(), ops)
+    results["insert_info"] = _timed_ops(lambda i: editor.insert_info(task(i)), ops)
+    results["queue_insert"] = _timed_ops(lambda i: editor.queue_insert(task(i)), ops)
+    results["flush_inserts"] = _timed_ops(lambda i: editor.flush_inserts(), 1)
+    found = []
+    results["search_task_to_update"] = _timed_ops(
+        lambda i: found.append(editor.search_task_to_update(f"{rng.choice(WORKS)} №{rng.randint(1, args.rows)} выполнено", llm)),
+        ops,
+    )
+    results["update_info"] = _timed_ops(lambda i: editor.update_info(found[i % len(found)]), ops)
+
+    # Правки «руками» в таблице и обновление зеркала другого Editor, у которого оно всегда устаревшее
+    sheet = client.spreadsheets[SPREADSHEET_ID].worksheets()[0]
+    watcher = Editor("benchmark", SPREADSHEET_ID, cache_ttl=0, gspread_client=client, drive_version_check=args.drive_version_check)
+
+    def hand_edit_and_refresh(i):
+        for _ in range(args.hand_edits):
+            sheet.cells[(rng.randint(4, args.rows + 3), 3)] = rng.choice(["🔄", "✅", "⚠️"])
+        if args.hand_edits:
+            backend.version += 1
+        watcher.get_last_filled_row()
+
+    results["mirror_refresh"] = _timed_ops(hand_edit_and_refresh, ops)
+    return {"operations": results, "sheets_api_calls": dict(backend.calls), "quota_errors": backend.quota_errors, "llm_calls": dict(llm.calls)}
+
+
+async def _drive_bot(bot, args) -> dict:
+    rng = random.Random(args.seed)
+    replies = Counter()
+
+    async def get_chat_member(chat_id, user_id):
+        return SimpleNamespace(status="administrator")
+
+    async def get_me():
+        return SimpleNamespace(id=1, username="benchmark_bot")
+
+    context = SimpleNamespace(bot=SimpleNamespace(get_chat_member=get_chat_member, get_me=get_me))
+    chat = SimpleNamespace(id=CHAT_ID, type="supergroup", title="Бенчмарк")
+
+    def make_update(i: int, text: str):
+        async def reply_text(reply, **kwargs):
+            replies[reply.split(":")[0].split("«")[0].strip()] += 1
+
+        message = SimpleNamespace(text=text, message_id=i, reply_text=reply_text, voice=None)
+        user = SimpleNamespace(id=1000 + i % args.senders)
+        return SimpleNamespace(message=message, effective_chat=chat, effective_user=user)
+
+    latencies = []
+
+    async def handle(i: int, text: str):
+        started_at = time.perf_counter()
+        await bot.on_group_message(make_update(i, text), context)
+        latencies.append(time.perf_counter() - started_at)
+
+    async def flush_loop():
+        # В боте это задача JobQueue; здесь Application не запускается
+        while True:
+            await asyncio.sleep(bot.INSERT_FLUSH_INTERVAL)
+            await bot._flush_inserts_job(None)
+
+    flush_task = asyncio.create_task(flush_loop()) if bot.WRITE_BEHIND else None
+    total = int(args.rate * args.seconds)
+    started_at = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        # Сообщения приходят равномерно с частотой rate
+        delay = started_at + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(handle(i, _message(rng, i, args.task_share))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started_at
+    if flush_task:
+        flush_task.cancel()
+        for editor in bot.editor_pool.editors():
+            await bot.run_blocking(editor.flush_inserts)
+    return {"messages": _summary(latencies, elapsed), "replies": dict(replies)}
+
+
+def run_bot_scenario(args) -> dict:
+    import bot
+    from routing import ChatRouter
+
+    # Журнал бота по каждому сообщению заглушил бы отчёт
+    logging.getLogger().setLevel(logging.WARNING)
+    backend = FakeBackend(args.sheets_latency, args.quota_error_rate, args.seed)
+    llm = FakeLLM(args.llm_latency, args.replay)
+    bot.editor_pool._client = FakeGspreadClient(backend, {SPREADSHEET_ID: make_spreadsheet(backend, args.rows, args.seed)})
+    bot.router = ChatRouter(default=(SPREADSHEET_ID, None))
+    bot.open_resources()
+    bot.get_client = lambda: llm
+    result = asyncio.run(_drive_bot(bot, args))
+    return {**result, "sheets_api_calls": dict(backend.calls), "quota_errors": backend.quota_errors, "llm_calls": dict(llm.calls)}
+
+
+def _configure_environment(args) -> None:
+    """
+    Настройки бота читаются из окружения при импорте модулей, поэтому задаются до импорта.
+    Лимиты запросов по умолчанию сняты: бенчмарк меряет код, а квоту изображают ошибки 429
+    заглушки. Чтобы учесть и лимитеры, задайте SHEETS_REQUESTS_PER_MINUTE / LLM_REQUESTS_PER_MINUTE явно.
+    """
+    defaults = {
+        "TELEGRAM_BOT_TOKEN": "benchmark",
+        "CREDENTIALS_PATH": "benchmark",
+        "SPREADSHEET_ID": SPREADSHEET_ID,
+        "SHEETS_REQUESTS_PER_MINUTE": "1000000",
+        "SHEETS_USER_REQUESTS_PER_MINUTE": "1000000",
+        "LLM_REQUESTS_PER_MINUTE": "1000000",
+        "LLM_CACHE_PATH": "",
+        "PENDING_STORE": "memory",
+        "DEAD_LETTER_PATH": os.path.join(args.workdir, "dead_letter.json"),
+        "INSERT_QUEUE_PATH": os.path.join(args.workdir, "insert_queue.{spreadsheet_id}.json"),
+        "METRICS_LOG_INTERVAL": "0",
+        "VOICE_ENABLED": "0",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", choices=("all", "editor", "bot"), default="all")
+    parser.add_argument("--rows", type=int, default=10000, help="задач в таблице")
+    parser.add_argument("--ops", type=int, default=200, help="операций каждого вида в сценарии editor")
+    parser.add_argument("--rate", type=float, default=100, help="сообщений в секунду в сценарии bot")
+    parser.add_argument("--seconds", type=float, default=5, help="длительность потока сообщений")
+    parser.add_argument("--senders", type=int, default=20, help="разных отправителей в чате")
+    parser.add_argument("--task-share", type=float, default=0.5, help="доля сообщений с поручением")
+    parser.add_argument("--sheets-latency", type=float, default=0.05, help="задержка запроса к Sheets, с")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="доля запросов к Sheets с ответом 429")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="задержка ответа LLM, с")
+    parser.add_argument("--cache-ttl", type=float, default=60, help="актуальность зеркала листа в сценарии editor, с")
+    parser.add_argument("--hand-edits", type=int, default=3, help="правок руками перед каждым обновлением зеркала")
+    parser.add_argument("--drive-version-check", action="store_true", help="проверять версию файла перед сверкой зеркала")
+    parser.add_argument("--replay", help="JSON-файл со списком записанных ответов LLM")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт одной JSON-строкой")
+    args = parser.parse_args()
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            args.replay = json.load(f)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        _configure_environment(args)
+        report = {}
+        if args.scenario in ("all", "editor"):
+            report["editor"] = run_editor_scenario(args)
+        if args.scenario in ("all", "bot"):
+            report["bot"] = run_bot_scenario(args)
+        from metrics import metrics
+
+        report["llm_tokens"] = [c for c in metrics.snapshot()["counters"] if c["name"] == "llm_tokens"]
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,65 @@
+import asyncio
+import contextvars
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
+
+# Отсчёт времени запуска — до импорта тяжёлых модулей (telegram, gspread, openai)
+_STARTED_AT = time.perf_counter()
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
+
+# .env — до импорта модулей бота: настройки script, ratelimit и др. читаются при импорте
+load_dotenv()
+
 from telegram import Update
 from telegram.constants import ChatMemberStatus
-from telegram.ext import Application, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, ChatMemberHandler, ContextTypes, MessageHandler, filters
 
-from script import Editor, client
+from batching import MessageBatcher
+from dead_letter import DeadLetterQueue
+from deadline_parser import today_moscow
+from digest import DeadlineIndex, DigestState, format_digest
+from metrics import current_chat, metrics
+from pending_store import create_pending_store
+from prefilter import TaskPrefilter, load_model
+from routing import ChatRouter, EditorPool
+from script import Editor, get_client, get_response_cache, is_transient_error, transcribe_voice
+from voice import VoiceTranscriber
 
-load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 PROXY = os.getenv("TELEGRAM_PROXY")
 CREDENTIALS_PATH = os.getenv("CREDENTIALS_PATH", "calm-photon-486609-u4-96ce79c043ec.json")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+# Маршруты «чат / категория -> таблица и лист» (JSON или путь к JSON, см. routing.ChatRouter)
+CHAT_ROUTES = os.getenv("CHAT_ROUTES")
+# Лимит запросов к каждой таблице в минуту
+SHEETS_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))
+# Общий лимит на все таблицы: все они открыты одним сервисным аккаунтом, а квота Sheets API —
+# 60 запросов в минуту на пользователя (по всем таблицам сразу)
+SHEETS_USER_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_USER_REQUESTS_PER_MINUTE", "60"))
+# Сколько секунд локальное зеркало листа считается актуальным
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "60"))
+# Устаревшее зеркало дочитывается по изменённым строкам, целиком — раз в SHEETS_FULL_RESYNC_INTERVAL секунд
+SHEETS_FULL_RESYNC_INTERVAL = float(os.getenv("SHEETS_FULL_RESYNC_INTERVAL", "600"))
+# Проверять время изменения таблицы через Drive API (нужен доступ drive.metadata.readonly)
+SHEETS_DRIVE_VERSION_CHECK = os.getenv("SHEETS_DRIVE_VERSION_CHECK", "0") == "1"
+# Отложенная запись задач: очередь на диске, пакетная запись раз в INSERT_FLUSH_INTERVAL секунд
+WRITE_BEHIND = os.getenv("SHEETS_WRITE_BEHIND", "1") != "0"
+INSERT_QUEUE_PATH = os.getenv("INSERT_QUEUE_PATH", "insert_queue.{spreadsheet_id}.json")
+INSERT_FLUSH_INTERVAL = float(os.getenv("INSERT_FLUSH_INTERVAL", "2"))
+# Хранилище задач, ожидающих срока: memory (LRU+TTL) или sqlite (переживает перезапуск)
+PENDING_STORE = os.getenv("PENDING_STORE", "sqlite")
+PENDING_DB_PATH = os.getenv("PENDING_DB_PATH", "pending_tasks.sqlite3")
+PENDING_TTL = float(os.getenv("PENDING_TTL", str(3 * 24 * 3600)))  # секунды
+PENDING_MAX_SIZE = int(os.getenv("PENDING_MAX_SIZE", "10000"))
+PENDING_SWEEP_INTERVAL = float(os.getenv("PENDING_SWEEP_INTERVAL", "600"))
+# Работа, не выполненная из-за сбоя LLM / Sheets, сохраняется и повторяется позже
+DEAD_LETTER_PATH = os.getenv("DEAD_LETTER_PATH", "dead_letter.json")
+DEAD_LETTER_REDRIVE_INTERVAL = float(os.getenv("DEAD_LETTER_REDRIVE_INTERVAL", "300"))
 def _parse_allowed_chat_ids() -> set[int]:
     raw = os.getenv("TELEGRAM_BOT_CHAT_ID", "").strip()
     if not raw:
@@ -22,6 +70,44 @@ def _parse_allowed_chat_ids() -> set[int]:
 ALLOWED_CHAT_IDS = _parse_allowed_chat_ids()
 _raw_leader_id = os.getenv("TELEGRAM_BOT_LEADER_ID")
 ALLOWED_LEADER = int(_raw_leader_id) if _raw_leader_id else None
+# Сколько синхронных вызовов (LLM, Google Sheets) выполняется одновременно
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "8"))
+# Сколько апдейтов Telegram обрабатывается параллельно (порядок сообщений одного отправителя сохраняется)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Режим webhook: задан WEBHOOK_URL — Telegram сам присылает апдейты на этот адрес, иначе polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Сколько одновременных соединений Telegram открывает к webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько секунд доверяем закэшированному статусу бота в чате
+ADMIN_STATUS_TTL = float(os.getenv("ADMIN_STATUS_TTL", "600"))
+# Локальный предфильтр «не задач» перед LLM
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") != "0"
+PREFILTER_THRESHOLD = float(os.getenv("PREFILTER_THRESHOLD", "0.9"))
+PREFILTER_MODEL = os.getenv("PREFILTER_MODEL")  # необязательно: «module:function»
+# Пакетный разбор сообщений: один запрос к LLM на несколько сообщений
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "0") == "1"
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "10"))
+LLM_BATCH_MAX_DELAY = float(os.getenv("LLM_BATCH_MAX_DELAY", "0.5"))  # секунды
+# Дайджест сроков: раз в DIGEST_INTERVAL секунд просроченные и близкие по сроку задачи — в чаты
+DIGEST_ENABLED = os.getenv("DIGEST_ENABLED", "0") == "1"
+DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", "300"))
+DIGEST_DUE_SOON_DAYS = int(os.getenv("DIGEST_DUE_SOON_DAYS", "2"))
+DIGEST_STATE_PATH = os.getenv("DIGEST_STATE_PATH", "digest_state.json")
+# Обход таблицы пропускается, если в лимите запросов к ней меньше стольких свободных запросов
+DIGEST_QUOTA_RESERVE = float(os.getenv("DIGEST_QUOTA_RESERVE", "5"))
+# Метрики: порт эндпоинта /metrics для Prometheus (0 — выключен) и период JSON-снимка в лог
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))  # 0 — не писать
+# Голосовые сообщения: распознавание в отдельном пуле, длинные режутся на части
+VOICE_ENABLED = os.getenv("VOICE_ENABLED", "1") != "0"
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "4"))
+VOICE_CHUNK_SECONDS = float(os.getenv("VOICE_CHUNK_SECONDS", "60"))
+# За сколько секунд от запуска процесса бот должен быть готов принимать апдейты
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "5"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -32,53 +118,502 @@ logging.getLogger("telegram").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-editor = None
-if CREDENTIALS_PATH and SPREADSHEET_ID:
-    editor = Editor(CREDENTIALS_PATH, SPREADSHEET_ID)
+router = ChatRouter.from_config(CHAT_ROUTES, default_spreadsheet_id=SPREADSHEET_ID)
+editor_pool = None
+if CREDENTIALS_PATH:
+    editor_pool = EditorPool(
+        CREDENTIALS_PATH,
+        requests_per_minute=SHEETS_REQUESTS_PER_MINUTE,
+        user_requests_per_minute=SHEETS_USER_REQUESTS_PER_MINUTE,
+        queue_path_template=INSERT_QUEUE_PATH if WRITE_BEHIND else None,
+        cache_ttl=SHEET_CACHE_TTL,
+        full_resync_interval=SHEETS_FULL_RESYNC_INTERVAL,
+        drive_version_check=SHEETS_DRIVE_VERSION_CHECK,
+    )
 
+# Предфильтр, локальные хранилища и состояние дайджеста создаются в open_resources, а не при импорте
+prefilter: TaskPrefilter | None = None
 # Ожидающие задачи без срока: (chat_id, user_id) -> {"task": формулировка, "task_dict": dict для insert_info}
-pending_tasks: dict[tuple[int, int], dict] = {}
+pending_tasks = None
+dead_letters: DeadLetterQueue | None = None
+digest_state: DigestState | None = None
 
 
-async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message or not update.message.text:
+def open_resources() -> None:
+    """
+    Загружает модель предфильтра (PREFILTER_MODEL) и открывает локальные хранилища
+    (SQLite pending_tasks, файлы очереди повторов и дайджеста в рабочем каталоге).
+    Вызывается из main() до запуска бота.
+    """
+    global prefilter, pending_tasks, dead_letters, digest_state
+    if PREFILTER_ENABLED:
+        prefilter = TaskPrefilter(
+            threshold=PREFILTER_THRESHOLD,
+            model=load_model(PREFILTER_MODEL) if PREFILTER_MODEL else None,
+        )
+    pending_tasks = create_pending_store(
+        PENDING_STORE, path=PENDING_DB_PATH, ttl=PENDING_TTL, max_size=PENDING_MAX_SIZE
+    )
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH)
+    if DIGEST_ENABLED:
+        digest_state = DigestState(DIGEST_STATE_PATH)
+
+# Пул потоков для блокирующих вызовов OpenAI SDK и gspread
+_executor = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix="blocking")
+# Отдельный поток для локальных хранилищ на диске (SQLite pending_tasks, файл очереди повторов):
+# запись с fsync не идёт в event loop, а короткие запросы не ждут в очереди _executor
+# за запросами к LLM и Sheets (с их повторами)
+_storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+# Блокировки по отправителям: сообщения одного человека в одном чате обрабатываются строго
+# по очереди (на этом держится ожидание срока в pending_tasks), разные отправители — параллельно.
+# (chat_id, user_id) -> [блокировка, сколько обработчиков её держат или ждут]
+_sender_locks: dict[tuple[int, int], list] = {}
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Выполняет синхронный вызов (Editor, OpenAI SDK, gspread) в пуле потоков,
+    не блокируя event loop. Размер пула — WORKER_POOL_SIZE.
+    Контекст (текущий чат для метрик) передаётся в поток: run_in_executor сам этого не делает.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, context.run, partial(func, *args, **kwargs))
+
+
+async def run_storage(func, *args, **kwargs):
+    """Выполняет обращение к локальному хранилищу (SQLite, JSON-файл) в потоке _storage_executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_storage_executor, partial(func, *args, **kwargs))
+
+
+async def _pending_call(func, *args):
+    """
+    Обращение к pending_tasks. SQLite — в потоке хранилищ: каждая запись фиксируется на диске;
+    хранилище в памяти — сразу.
+    """
+    if PENDING_STORE == "memory":
+        return func(*args)
+    return await run_storage(func, *args)
+
+
+async def _extract_tasks_batch(texts: list[str]) -> list[dict | None]:
+    # Пакет собран из сообщений разных чатов — не приписываем его первому из них
+    current_chat.set(None)
+    return await run_blocking(Editor.extract_tasks_from_chat_messages, texts, get_client())
+
+
+batcher = None
+if LLM_BATCH_ENABLED:
+    batcher = MessageBatcher(
+        _extract_tasks_batch,
+        max_batch_size=LLM_BATCH_MAX_SIZE,
+        max_delay=LLM_BATCH_MAX_DELAY,
+    )
+
+
+def _task_route(chat_id: int, task_dict: dict):
+    """Таблица и лист для задачи (по категории или чату) или None, если таблица не настроена."""
+    if not editor_pool:
+        return None
+    return router.route(chat_id, task_dict.get("category"))
+
+
+async def _insert_task(route, task_dict: dict) -> int:
+    """Записывает задачу: в очередь отложенной записи (WRITE_BEHIND) или сразу в таблицу."""
+    spreadsheet_id, sheet_name = route
+    editor = await run_blocking(editor_pool.get, spreadsheet_id)
+    if WRITE_BEHIND:
+        return await run_blocking(editor.queue_insert, task_dict, sheet_name=sheet_name)
+    return await run_blocking(editor.insert_info, task_dict, sheet_name=sheet_name)
+
+
+async def _flush_inserts_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая запись очередей задач во все открытые таблицы (раз в INSERT_FLUSH_INTERVAL)."""
+    for editor in editor_pool.editors():
+        if not editor.pending_inserts():
+            continue
+        try:
+            written = await run_blocking(editor.flush_inserts)
+            if written:
+                logger.info(
+                    "Из очереди записано в таблицу %s задач: %s", editor.spreadsheet_id, written
+                )
+        except Exception as e:
+            logger.exception("Ошибка записи очереди задач: %s", e)
+
+
+async def _notify(bot, chat_id: int, message_id: int | None, text: str) -> None:
+    """Ответ в чат вне обработчика апдейта (для отложенной обработки)."""
+    try:
+        await bot.send_message(chat_id, text, reply_to_message_id=message_id)
+    except Exception as e:
+        logger.warning("Не удалось отправить сообщение в чат %s: %s", chat_id, e)
+
+
+async def _redrive_dead_letter(bot, item: dict) -> None:
+    payload = item["payload"]
+    chat_id = payload["chat_id"]
+    message_id = payload.get("message_id")
+    if item["kind"] == "insert":
+        task_dict = payload["task_dict"]
+        row = await _insert_task(tuple(payload["route"]), task_dict)
+        logger.info("Отложенная задача записана в таблицу, строка %s", row)
+        await _notify(bot, chat_id, message_id, f"Задача добавлена в таблицу: «{task_dict.get('task') or 'Задача'}»")
+        return
+    # kind == "message": сообщение, которое не удалось разобрать из-за сбоя LLM
+    current_chat.set(chat_id)
+    async with _sender_lock(chat_id, payload["user_id"]):
+        task_dict = await run_blocking(Editor.extract_task_from_chat_message, payload["text"], get_client())
+        if not task_dict:
+            return
+        formulation = task_dict.get("task") or "Задача"
+        if not task_dict.get("deadline"):
+            await _pending_call(pending_tasks.set, (chat_id, payload["user_id"]), {"task": formulation, "task_dict": task_dict})
+            await _notify(
+                bot,
+                chat_id,
+                message_id,
+                f"По задаче «{formulation}» не указан срок. Ответьте на это сообщение, указав срок (например, 25.02.2025), или напишите, что срок пока неизвестен / задачу пока не добавлять.",
+            )
+            return
+        route = _task_route(chat_id, task_dict)
+        if not route:
+            return
+        try:
+            await _insert_task(route, task_dict)
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            await run_storage(dead_letters.put, "insert", {"chat_id": chat_id, "message_id": message_id, "route": list(route), "task_dict": task_dict}, e)
+            return
+        await _notify(bot, chat_id, message_id, f"Задача добавлена в таблицу: «{formulation}»")
+
+
+async def _redrive_dead_letters_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Повторяет работу из очереди «мёртвых писем» (раз в DEAD_LETTER_REDRIVE_INTERVAL)."""
+    for item in dead_letters.pending():
+        try:
+            await _redrive_dead_letter(context.bot, item)
+        except Exception as e:
+            logger.warning("Повтор %s (%s) не удался: %s", item["id"], item["kind"], e)
+            await run_storage(dead_letters.failed, item["id"], e, permanent=not is_transient_error(e))
+        else:
+            await run_storage(dead_letters.done, item["id"])
+
+
+async def _log_metrics_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Снимок метрик одной JSON-строкой (агрегаты по этапам, чатам и моделям)."""
+    logging.getLogger("metrics").info(metrics.to_json())
+
+
+def _known_chats() -> set[int]:
+    """Чаты, где бот работает: из настроек и те, где он уже видел себя администратором."""
+    admin_statuses = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    seen = {chat_id for chat_id, (status, _) in _member_status_cache.items() if status in admin_statuses}
+    return ALLOWED_CHAT_IDS | seen
+
+
+async def _send_digests(bot, spreadsheet_id: str) -> None:
+    chats = router.chats_for(spreadsheet_id, _known_chats())
+    if not chats:
+        return
+    editor = await run_blocking(editor_pool.get, spreadsheet_id)
+    # Фоновый обход не должен отнимать квоту у обработки сообщений
+    if editor.limiter is not None and editor.limiter.available() < DIGEST_QUOTA_RESERVE + 1:
+        logger.info("Дайджест по таблице %s отложен: мало свободной квоты запросов", spreadsheet_id)
+        return
+    with metrics.span("digest.scan"):
+        sheets = await run_blocking(editor.read_all_sheets)
+        today = today_moscow()
+        index = DeadlineIndex(sheets, today)
+    overdue_all = index.overdue(today)
+    due_soon_all = index.due_soon(today, DIGEST_DUE_SOON_DAYS)
+    for chat_id, sheet in chats.items():
+        overdue = [e for e in overdue_all if sheet is None or e.sheet == sheet]
+        due_soon = [e for e in due_soon_all if sheet is None or e.sheet == sheet]
+        overdue = digest_state.new_entries(chat_id, "overdue", overdue, today)
+        due_soon = digest_state.new_entries(chat_id, "due_soon", due_soon, today)
+        text = format_digest(overdue, due_soon, DIGEST_DUE_SOON_DAYS)
+        if not text:
+            continue
+        try:
+            await bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.warning("Не удалось отправить дайджест в чат %s: %s", chat_id, e)
+            continue
+        digest_state.mark_sent(chat_id, "overdue", overdue, today)
+        digest_state.mark_sent(chat_id, "due_soon", due_soon, today)
+        logger.info("Дайджест в чат %s: просрочено %s, скоро срок %s", chat_id, len(overdue), len(due_soon))
+
+
+async def _digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обход таблиц раз в DIGEST_INTERVAL: одно чтение всех листов на таблицу (Editor.read_all_sheets),
+    индекс сроков и дайджест в каждый чат этой таблицы. Об одной задаче — не чаще раза в день.
+    """
+    for spreadsheet_id in sorted(router.spreadsheet_ids()):
+        try:
+            await _send_digests(context.bot, spreadsheet_id)
+        except Exception as e:
+            logger.warning("Ошибка дайджеста по таблице %s: %s", spreadsheet_id, e)
+
+
+async def _sweep_pending_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Удаляет ожидающие задачи, на которые так и не ответили (раз в PENDING_SWEEP_INTERVAL)."""
+    removed = await _pending_call(pending_tasks.sweep)
+    if removed:
+        logger.info("Удалено просроченных ожидающих задач: %s", removed)
+
+
+def _transcribe_voice(data: bytes) -> str:
+    return transcribe_voice(data, get_client())
+
+
+transcriber = None
+if VOICE_ENABLED:
+    transcriber = VoiceTranscriber(
+        _transcribe_voice,
+        max_workers=VOICE_WORKERS,
+        chunk_seconds=VOICE_CHUNK_SECONDS,
+    )
+
+
+@asynccontextmanager
+async def _sender_lock(chat_id: int, user_id: int):
+    """Очередь сообщений отправителя; запись удаляется, когда очередь пуста."""
+    key = (chat_id, user_id)
+    entry = _sender_locks.get(key)
+    if entry is None:
+        entry = _sender_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _sender_locks[key]
+
+
+def _sender_id(update: Update) -> int:
+    user = update.effective_user
+    return user.id if user else 0
+
+
+# id бота — получаем один раз при старте (post_init)
+bot_id: int | None = None
+# Статус бота в чатах: chat_id -> (status, время истечения по time.monotonic())
+_member_status_cache: dict[int, tuple[str, float]] = {}
+
+
+async def _bot_is_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    """
+    Проверяет, что бот — администратор чата. Статус кэшируется на ADMIN_STATUS_TTL секунд
+    и обновляется по апдейтам my_chat_member (on_my_chat_member).
+    """
+    global bot_id
+    cached = _member_status_cache.get(chat_id)
+    if cached and cached[1] > time.monotonic():
+        status = cached[0]
+    else:
+        if bot_id is None:
+            bot_id = (await context.bot.get_me()).id
+        member = await context.bot.get_chat_member(chat_id, bot_id)
+        status = member.status
+        _member_status_cache[chat_id] = (status, time.monotonic() + ADMIN_STATUS_TTL)
+    return status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+
+async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Бота повысили/понизили/удалили из чата — обновляем кэш статуса."""
+    change = update.my_chat_member
+    if not change:
+        return
+    chat_id = change.chat.id
+    status = change.new_chat_member.status
+    _member_status_cache[chat_id] = (status, time.monotonic() + ADMIN_STATUS_TTL)
+    logger.info("Статус бота в чате %s изменился: %s", chat_id, status)
+
+
+async def _warm_up(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Создаёт клиент LLM и открывает таблицы из маршрутов (а с ними — очереди отложенной
+    записи с диска), пока бот уже принимает апдейты. Ошибка прогрева не мешает запуску:
+    таблица откроется при первой задаче.
+    """
+    started_at = time.perf_counter()
+    jobs = [run_blocking(get_client)]
+    spreadsheet_ids = sorted(router.spreadsheet_ids()) if editor_pool else []
+    jobs += [run_blocking(editor_pool.get, spreadsheet_id) for spreadsheet_id in spreadsheet_ids]
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    for spreadsheet_id, result in zip([None, *spreadsheet_ids], results):
+        if isinstance(result, Exception):
+            logger.warning("Прогрев %s не удался: %s", spreadsheet_id or "клиента LLM", result)
+    logger.info("Прогрев завершён за %.2f с", time.perf_counter() - started_at)
+
+
+async def post_init(app: Application) -> None:
+    global bot_id
+    # Данные бота уже получены при инициализации Application — без лишнего get_me
+    bot_id = app.bot.id
+    logger.info("Бот @%s (id=%s) запущен", app.bot.username, bot_id)
+    # Фоновые задачи — через JobQueue: запускаются вместе с Application и останавливаются при выходе
+    jobs = app.job_queue
+    if jobs is None:
+        raise RuntimeError("Нужен JobQueue: установите python-telegram-bot[job-queue]")
+    jobs.run_once(_warm_up, 0, name="warm_up")
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        logger.info("Метрики Prometheus: http://0.0.0.0:%s/metrics", METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        jobs.run_repeating(_log_metrics_job, METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL, name="log_metrics")
+    logger.info("Ожидающих срока задач (%s): %s", PENDING_STORE, len(pending_tasks))
+    jobs.run_repeating(_sweep_pending_job, PENDING_SWEEP_INTERVAL, first=0, name="sweep_pending")
+    if len(dead_letters):
+        logger.info("В очереди повторов записей: %s", len(dead_letters))
+    jobs.run_repeating(
+        _redrive_dead_letters_job, DEAD_LETTER_REDRIVE_INTERVAL, first=DEAD_LETTER_REDRIVE_INTERVAL, name="redrive_dead_letters"
+    )
+    if editor_pool and WRITE_BEHIND:
+        jobs.run_repeating(_flush_inserts_job, INSERT_FLUSH_INTERVAL, first=INSERT_FLUSH_INTERVAL, name="flush_inserts")
+    if editor_pool and DIGEST_ENABLED:
+        jobs.run_repeating(_digest_job, DIGEST_INTERVAL, first=DIGEST_INTERVAL, name="digest")
+    startup_seconds = time.perf_counter() - _STARTED_AT
+    if startup_seconds > STARTUP_BUDGET_SECONDS:
+        logger.warning("Запуск занял %.2f с — больше бюджета %.2f с", startup_seconds, STARTUP_BUDGET_SECONDS)
+    else:
+        logger.info("Запуск занял %.2f с", startup_seconds)
+
+
+async def post_shutdown(app: Application) -> None:
+    if transcriber:
+        transcriber.close()
+    response_cache = get_response_cache()
+    if response_cache:
+        logger.info("Кэш ответов LLM: %s", response_cache.stats())
+    logging.getLogger("metrics").info(metrics.to_json())
+    if editor_pool and WRITE_BEHIND:
+        for editor in editor_pool.editors():
+            if editor.pending_inserts():
+                written = await run_blocking(editor.flush_inserts)
+                logger.info("При остановке записано задач из очереди: %s", written)
+
+
+async def _insert_failed(update: Update, route, task_dict: dict, error: Exception) -> None:
+    """Таблица временно недоступна: задача уходит в очередь повторов, а не теряется."""
+    logger.exception("Ошибка записи в таблицу: %s", error)
+    if not is_transient_error(error):
+        # Повтор не поможет (например, лист переименован) — сообщаем сразу
+        await update.message.reply_text("Не удалось записать задачу в таблицу.")
         return
+    await run_storage(
+        dead_letters.put,
+        "insert",
+        {
+            "chat_id": update.effective_chat.id,
+            "message_id": update.message.message_id,
+            "route": list(route),
+            "task_dict": task_dict,
+        },
+        error,
+    )
+    await update.message.reply_text(
+        "Не удалось записать задачу в таблицу сейчас — запишу автоматически, как только таблица станет доступна."
+    )
+
+
+def _is_watched_message(update: Update) -> bool:
+    """Сообщение из разрешённой группы от разрешённого отправителя."""
     chat = update.effective_chat
     messenger = update.effective_user
     if not chat or chat.type not in ("group", "supergroup"):
-        return
+        return False
     if ALLOWED_CHAT_IDS and chat.id not in ALLOWED_CHAT_IDS:
-        return
+        return False
     if ALLOWED_LEADER is not None and messenger and messenger.id != ALLOWED_LEADER:
+        return False
+    return True
+
+
+async def _can_write_in_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    try:
+        return await _bot_is_admin(context, chat_id)
+    except Exception as e:
+        logger.warning("Не удалось проверить права в чате %s: %s", chat_id, e)
+        return False
+
+
+async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.message or not update.message.text:
+        return
+    if not _is_watched_message(update):
+        return
+    chat = update.effective_chat
+    current_chat.set(chat.id)
+    # Блокировку берём до первого await, чтобы сохранить порядок сообщений отправителя
+    with metrics.span("handler.message"):
+        async with _sender_lock(chat.id, _sender_id(update)):
+            with metrics.span("handler.admin_check"):
+                can_write = await _can_write_in_chat(context, chat.id)
+            if not can_write:
+                return
+            await _handle_group_message(update, context, update.message.text)
+
+
+async def on_group_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Голосовое сообщение: скачивается в память, распознаётся в пуле VoiceTranscriber
+    и дальше обрабатывается как текст. Распознавание идёт без блокировки чата, поэтому
+    текстовые сообщения не ждут; голосовое встаёт в очередь отправителя, когда готов текст.
+    """
+    voice = update.message.voice if update.message else None
+    if not voice or not transcriber:
+        return
+    if not _is_watched_message(update):
+        return
+    chat = update.effective_chat
+    current_chat.set(chat.id)
+    with metrics.span("handler.admin_check"):
+        can_write = await _can_write_in_chat(context, chat.id)
+    if not can_write:
         return
     try:
-        me = await context.bot.get_me()
-        member = await context.bot.get_chat_member(chat.id, me.id)
-        status = member.status
-        if status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-            return
+        with metrics.span("voice.download"):
+            voice_file = await context.bot.get_file(voice.file_id)
+            data = await voice_file.download_as_bytearray()
+        with metrics.span("voice.transcribe"):
+            text = await transcriber.transcribe(bytes(data))
     except Exception as e:
-        logger.warning("Не удалось проверить права в чате %s: %s", chat.id, e)
+        logger.exception("Ошибка распознавания голосового сообщения: %s", e)
+        await update.message.reply_text("Не удалось распознать голосовое сообщение.")
         return
+    logger.info("Голосовое сообщение (%s с) распознано: %s символов", voice.duration, len(text))
+    with metrics.span("handler.message", source="voice"):
+        async with _sender_lock(chat.id, _sender_id(update)):
+            await _handle_group_message(update, context, text)
+
 
-    text = update.message.text.strip()
+async def _handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    chat = update.effective_chat
+    text = text.strip()
     if not text:
         return
 
     chat_id = chat.id
-    user = update.effective_user
-    user_id = user.id if user else 0
+    user_id = _sender_id(update)
     chat_title = getattr(chat, "title", None) or chat.id
     logger.info("Сообщение в чате «%s» (id=%s): %s", chat_title, chat_id, text[:200] + ("..." if len(text) > 200 else ""))
 
     # Есть ли ожидающая задача без срока от этого пользователя?
     pending_key = (chat_id, user_id)
-    if pending_key in pending_tasks:
-        pending = pending_tasks[pending_key]
+    pending = await _pending_call(pending_tasks.get, pending_key)
+    if pending:
         try:
-            follow_up = Editor.parse_follow_up_for_deadline(
-                pending["task"], text, client
-            )
+            with metrics.span("handler.follow_up"):
+                follow_up = await run_blocking(
+                    Editor.parse_follow_up_for_deadline, pending["task"], text, get_client()
+                )
         except Exception as e:
             logger.exception("Ошибка LLM при разборе ответа по сроку: %s", e)
             await update.message.reply_text(
@@ -87,21 +622,22 @@ async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             return
         if follow_up["action"] == "add":
             task_dict = {**pending["task_dict"], "deadline": follow_up["deadline"]}
-            del pending_tasks[pending_key]
-            if editor:
+            await _pending_call(pending_tasks.pop, pending_key)
+            route = _task_route(chat_id, task_dict)
+            if route:
                 try:
-                    row = editor.insert_info(task_dict)
+                    with metrics.span("handler.insert"):
+                        row = await _insert_task(route, task_dict)
                     title = task_dict.get("task") or "Задача"
                     logger.info("Задача (со сроком из ответа) записана в таблицу, строка %s", row)
                     await update.message.reply_text(f"Задача добавлена в таблицу: «{title}»")
                 except Exception as e:
-                    logger.exception("Ошибка записи в таблицу: %s", e)
-                    await update.message.reply_text("Не удалось записать задачу в таблицу.")
+                    await _insert_failed(update, route, task_dict, e)
             else:
                 await update.message.reply_text("Таблица не настроена, задачу записать нельзя.")
             return
         if follow_up["action"] == "decline":
-            del pending_tasks[pending_key]
+            await _pending_call(pending_tasks.pop, pending_key)
             await update.message.reply_text(
                 "Хорошо, задачу не добавляю. Если позже понадобится внести её в таблицу — напишите с указанием срока."
             )
@@ -112,11 +648,40 @@ async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return
 
+    if prefilter:
+        with metrics.span("handler.prefilter"):
+            decision = prefilter.check(text)
+        if not decision.is_candidate:
+            metrics.inc("prefilter_skipped")
+            stats = prefilter.stats
+            logger.info(
+                "Предфильтр: не задача (%s, уверенность %.2f), пропуск LLM; пропущено %s из %s (%.0f%%)",
+                decision.reason,
+                decision.confidence,
+                stats.skipped,
+                stats.checked,
+                stats.skip_ratio * 100,
+            )
+            return
+
     try:
         logger.info("Отправка в LLM на разбор (задача или нет)...")
-        task_dict = Editor.extract_task_from_chat_message(text, client)
+        with metrics.span("handler.extract"):
+            if batcher:
+                task_dict = await batcher.submit(text)
+            else:
+                task_dict = await run_blocking(Editor.extract_task_from_chat_message, text, get_client())
     except Exception as e:
         logger.exception("Ошибка LLM при разборе сообщения: %s", e)
+        if not is_transient_error(e):
+            # Ответ не по схеме или 400 при temperature 0 повторится и при повторе
+            return
+        await run_storage(
+            dead_letters.put,
+            "message",
+            {"chat_id": chat_id, "user_id": user_id, "message_id": update.message.message_id, "text": text},
+            e,
+        )
         return
 
     if not task_dict:
@@ -134,7 +699,7 @@ async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # Задачу без срока в таблицу не ставим — запрашиваем срок и запоминаем задачу
     if not task_dict.get("deadline"):
         formulation = task_dict.get("task") or "Задача"
-        pending_tasks[pending_key] = {"task": formulation, "task_dict": task_dict}
+        await _pending_call(pending_tasks.set, pending_key, {"task": formulation, "task_dict": task_dict})
         logger.info("Задача без срока сохранена в ожидание: «%s»", formulation)
         await update.message.reply_text(
             f"По задаче «{formulation}» не указан срок. Ответьте на это сообщение, указав срок (например, 25.02.2025), или напишите, что срок пока неизвестен / задачу пока не добавлять.",
@@ -142,32 +707,58 @@ async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return
 
-    if not editor:
-        logger.error("Editor не инициализирован (CREDENTIALS_PATH / SPREADSHEET_ID)")
+    route = _task_route(chat_id, task_dict)
+    if not route:
+        logger.error("Таблица для чата %s не настроена (CREDENTIALS_PATH / SPREADSHEET_ID / CHAT_ROUTES)", chat_id)
         await update.message.reply_text("Таблица не настроена, задачу записать нельзя.")
         return
 
     try:
-        row = editor.insert_info(task_dict)
+        with metrics.span("handler.insert"):
+            row = await _insert_task(route, task_dict)
         title = task_dict.get("task") or "Задача"
         logger.info("Задача записана в таблицу, строка %s", row)
-        await update.message.reply_text(f"Задача добавлена в таблицу: «{title}»")
+        with metrics.span("handler.reply"):
+            await update.message.reply_text(f"Задача добавлена в таблицу: «{title}»")
+        metrics.inc("tasks_added")
     except Exception as e:
-        logger.exception("Ошибка записи в таблицу: %s", e)
-        await update.message.reply_text("Не удалось записать задачу в таблицу.")
+        await _insert_failed(update, route, task_dict, e)
 
 
 def main() -> None:
+    logger.info("Импорт модулей занял %.2f с", time.perf_counter() - _STARTED_AT)
     if not TOKEN:
         raise RuntimeError("Задайте TELEGRAM_BOT_TOKEN в .env")
-    builder = Application.builder().token(TOKEN)
+    open_resources()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
     if PROXY:
         builder.proxy(PROXY)
     app = builder.build()
     app.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, on_group_message),
     )
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    app.add_handler(MessageHandler(filters.VOICE, on_group_voice))
+    app.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    # Только те апдейты, которые бот обрабатывает
+    allowed_updates = [Update.MESSAGE, Update.MY_CHAT_MEMBER]
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        app.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+"""
+Очередь «мёртвых писем»: работа, которую не удалось выполнить из-за временного сбоя внешнего
+сервиса (LLM или Google Sheets), сохраняется в JSON-файл и позже выполняется повторно (redrive).
+Записи, исчерпавшие попытки или упавшие с постоянной ошибкой, удаляются из файла (с записью в журнал).
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterQueue:
+    def __init__(self, path: str, max_attempts: int = 20):
+        self.path = path
+        # После стольких неудачных повторов запись удаляется из очереди
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._items: list[dict] = []
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                items = json.load(f)
+            # Исчерпавшие попытки записи из старых версий файла
+            for item in items:
+                if item["attempts"] >= max_attempts:
+                    self._drop(item, item["error"])
+            self._items = [item for item in items if item["attempts"] < max_attempts]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._items, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def put(self, kind: str, payload: dict, error: Exception | str) -> None:
+        item = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "payload": payload,
+            "error": str(error),
+            "attempts": 0,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._items.append(item)
+            self._save()
+
+    def pending(self) -> list[dict]:
+        """Записи, которые ещё можно повторить."""
+        with self._lock:
+            return [dict(item) for item in self._items]
+
+    def done(self, item_id: str) -> None:
+        with self._lock:
+            self._items = [item for item in self._items if item["id"] != item_id]
+            self._save()
+
+    def failed(self, item_id: str, error: Exception | str, permanent: bool = False) -> None:
+        """Повтор не удался; permanent — ошибка не временная, повторять дальше бессмысленно."""
+        with self._lock:
+            for item in self._items:
+                if item["id"] == item_id:
+                    item["attempts"] += 1
+                    item["error"] = str(error)
+                    if permanent or item["attempts"] >= self.max_attempts:
+                        self._drop(item, error)
+                        self._items.remove(item)
+                    break
+            self._save()
+
+    @staticmethod
+    def _drop(item: dict, error: Exception | str) -> None:
+        # Содержимое — в журнал: по нему задачу можно восстановить вручную
+        logger.error(
+            "Запись %s (%s) удалена из очереди повторов после %s попыток: %s; данные: %s",
+            item["id"], item["kind"], item["attempts"], error, json.dumps(item["payload"], ensure_ascii=False),
+        )
@@ -0,0 +1,210 @@
+"""
+Разбор сроков и отказов в коротких ответах на вопрос «не указан срок».
+
+parse_follow_up решает локально типовые ответы («25.02», «завтра», «к пятнице»,
+«через 3 дня», «не добавляй») и возвращает None, если не уверен — тогда решает LLM.
+normalize_deadline проверяет и приводит к дд.мм.гггг срок, который вернул LLM.
+«Сегодня» — всегда по Москве.
+"""
+import calendar
+import re
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+DATE_FORMAT = "%d.%m.%Y"
+
+MONTHS = {
+    "январ": 1, "феврал": 2, "март": 3, "апрел": 4, "ма": 5, "июн": 6,
+    "июл": 7, "август": 8, "сентябр": 9, "октябр": 10, "ноябр": 11, "декабр": 12,
+}
+# Начала названий дней недели (понедельник = 0), покрывают «пятница», «пятницы», «пятницу», «пятнице»
+WEEKDAYS = {
+    "понедельн": 0, "вторник": 1, "сред": 2, "четверг": 3, "пятниц": 4, "суббот": 5, "воскресен": 6,
+}
+NUMBER_WORDS = {
+    "один": 1, "одну": 1, "два": 2, "две": 2, "три": 3, "четыре": 4, "пять": 5, "шесть": 6,
+    "семь": 7, "восемь": 8, "девять": 9, "десять": 10, "пару": 2, "несколько": None,
+}
+DECLINE_PHRASES = (
+    "не добавля", "не добавлю", "не добавь", "не ставь", "не ставить", "не заводи", "не записыва",
+    "не надо", "не нужно", "отмена", "отмени", "отбой", "срок неизвестен", "срок пока неизвестен",
+    "пока не знаю", "не знаю", "неизвестно", "забудь",
+)
+# Слова, которые могут окружать срок и не меняют его смысла
+FILLER_WORDS = {
+    "срок", "сроки", "дедлайн", "до", "к", "ко", "на", "в", "во", "по",
+    "крайний", "это", "эту", "этой", "этот", "ближайшую", "ближайший", "ближайшей", "пожалуйста",
+    "давай", "давайте", "ставь", "поставь", "поставьте", "пусть", "будет", "тогда", "ну", "да",
+    "включительно", "срока", "года", "г",
+}
+
+_NOT_LATER_RE = re.compile(r"не\s+(?:позже|позднее)")
+# Просьба всё-таки поставить задачу («не нужно срок, просто добавь») — без «не» перед словом
+_ADD_INTENT_RE = re.compile(r"(?<!не )\b(?:добав|запиш|записыв|постав|ставь|заведи|заводи|внеси|внос)")
+_DATE_HINT_RE = re.compile(r"\d|сегодня|завтра|через|недел|месяц|понедельн|вторник|сред[аеуы]|четверг|пятниц|суббот|воскресен")
+_WORD_RE = re.compile(r"[0-9а-яёa-z]+(?:[./-][0-9]+){0,2}")
+_NUMERIC_DATE_RE = re.compile(r"^(\d{1,2})[./-](\d{1,2})(?:[./-](\d{2}|\d{4}))?$")
+_ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+
+
+def today_moscow() -> date:
+    return datetime.now(MOSCOW_TZ).date()
+
+
+def _make_date(day: int, month: int, year: int | None, today: date) -> date | None:
+    """Дата без года — ближайшая будущая (или сегодняшняя)."""
+    try:
+        if year is not None:
+            if year < 100:
+                year += 2000
+            return date(year, month, day)
+        result = date(today.year, month, day)
+        if result < today:
+            result = date(today.year + 1, month, day)
+        return result
+    except ValueError:
+        return None
+
+
+def _month_from_word(word: str) -> int | None:
+    for stem, month in MONTHS.items():
+        # «ма» — только «мая»/«май», чтобы не путать с другими словами
+        if stem == "ма":
+            if word in ("мая", "май"):
+                return month
+        elif word.startswith(stem):
+            return month
+    return None
+
+
+def _weekday_from_word(word: str) -> int | None:
+    for stem, weekday in WEEKDAYS.items():
+        if word.startswith(stem):
+            return weekday
+    return None
+
+
+def parse_deadline(text: str, today: date | None = None) -> date | None:
+    """
+    Разбирает сообщение, которое целиком является сроком. Возвращает дату
+    или None, если в сообщении есть что-то кроме срока или формулировка неоднозначна.
+    """
+    today = today or today_moscow()
+    text = _NOT_LATER_RE.sub(" ", (text or "").lower())
+    words = [w for w in _WORD_RE.findall(text) if w not in FILLER_WORDS]
+    if not words or len(words) > 4:
+        return None
+    phrase = " ".join(words)
+
+    if len(words) == 1:
+        word = words[0]
+        match = _NUMERIC_DATE_RE.match(word)
+        if match:
+            day, month, year = match.groups()
+            return _make_date(int(day), int(month), int(year) if year else None, today)
+        if word == "сегодня":
+            return today
+        if word == "завтра":
+            return today + timedelta(days=1)
+        if word == "послезавтра":
+            return today + timedelta(days=2)
+        weekday = _weekday_from_word(word)
+        if weekday is not None:
+            days_ahead = (weekday - today.weekday()) % 7
+            # В тот же день недели непонятно, сегодня или через неделю — пусть решает LLM
+            return today + timedelta(days=days_ahead) if days_ahead else None
+        return None
+
+    # «25 февраля», «25 февраля 2026»
+    if words[0].isdigit() and len(words) in (2, 3):
+        month = _month_from_word(words[1])
+        year = None
+        if len(words) == 3:
+            if not words[2].isdigit():
+                return None
+            year = int(words[2])
+        if month:
+            return _make_date(int(words[0]), month, year, today)
+        return None
+
+    # «через 3 дня», «через неделю», «через пару недель»
+    if words[0] == "через":
+        rest = words[1:]
+        count = 1
+        if len(rest) == 2:
+            count = int(rest[0]) if rest[0].isdigit() else NUMBER_WORDS.get(rest[0])
+            if not count or count > 1000:
+                return None
+            unit = rest[1]
+        elif len(rest) == 1:
+            unit = rest[0]
+        else:
+            return None
+        if unit.startswith(("день", "дня", "дней")):
+            return today + timedelta(days=count)
+        if unit.startswith("недел"):
+            return today + timedelta(weeks=count)
+        if unit.startswith("месяц"):
+            month_index = today.month - 1 + count
+            year, month = today.year + month_index // 12, month_index % 12 + 1
+            day = min(today.day, calendar.monthrange(year, month)[1])
+            return date(year, month, day)
+        return None
+
+    # «конца недели» — пятница текущей недели, «конца месяца» — последний день месяца
+    if phrase in ("конца недели", "конец недели"):
+        days_ahead = 4 - today.weekday()
+        return today + timedelta(days=days_ahead) if days_ahead >= 0 else None
+    if phrase in ("конца месяца", "конец месяца"):
+        return date(today.year, today.month, calendar.monthrange(today.year, today.month)[1])
+    return None
+
+
+def is_decline(text: str) -> bool:
+    """Короткий ответ с явным отказом ставить задачу."""
+    normalized = " ".join((text or "").lower().split())
+    if len(normalized.split()) > 8:
+        return False
+    return any(phrase in normalized for phrase in DECLINE_PHRASES)
+
+
+def parse_follow_up(text: str, today: date | None = None) -> dict | None:
+    """
+    Локальный разбор ответа на вопрос о сроке.
+    Возвращает {"action": "add", "deadline": "дд.мм.гггг"}, {"action": "decline"}
+    или None, если ответ нужно отдать LLM.
+    """
+    if is_decline(text):
+        # «не знаю, давай в пятницу» — отказ вместе со сроком, «не нужно срок, просто добавь» —
+        # вместе с просьбой добавить: пусть разбирается LLM
+        normalized = (text or "").lower()
+        if _DATE_HINT_RE.search(normalized) or _ADD_INTENT_RE.search(normalized):
+            return None
+        return {"action": "decline"}
+    deadline = parse_deadline(text, today)
+    if deadline is None:
+        return None
+    return {"action": "add", "deadline": deadline.strftime(DATE_FORMAT)}
+
+
+def normalize_deadline(value, today: date | None = None) -> str | None:
+    """
+    Проверяет срок, который вернул LLM: существующая дата в одном из форматов
+    дд.мм.гггг / дд.мм.гг / дд.мм / гггг-мм-дд. Возвращает дд.мм.гггг или None.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    today = today or today_moscow()
+    match = _ISO_DATE_RE.match(value)
+    if match:
+        year, month, day = (int(x) for x in match.groups())
+        result = _make_date(day, month, year, today)
+    else:
+        match = _NUMERIC_DATE_RE.match(value)
+        if not match:
+            return None
+        day, month, year = match.groups()
+        result = _make_date(int(day), int(month), int(year) if year else None, today)
+    return result.strftime(DATE_FORMAT) if result else None
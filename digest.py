@@ -0,0 +1,140 @@
+"""
+Дайджест сроков: просроченные задачи и задачи со сроком в ближайшие дни.
+
+DeadlineIndex строится из строк всех листов таблицы (один запрос values_batch_get,
+см. Editor.read_all_sheets) и хранит открытые задачи, отсортированные по сроку, —
+выборка «просрочено» / «скоро срок» идёт бинарным поиском без повторного чтения таблицы.
+DigestState помнит, о чём уже писали в чат, чтобы одна задача попадала
+в дайджест не чаще раза в день.
+"""
+import bisect
+import json
+import os
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+from deadline_parser import DATE_FORMAT, normalize_deadline, today_moscow
+from script import FIRST_DATA_ROW, MIRROR_FIRST_COL
+
+# Статус выполненной задачи — такие задачи в дайджест не попадают
+DONE_STATUS = "✅"
+# Сколько задач показывать в одном разделе дайджеста
+DIGEST_SECTION_LIMIT = 20
+
+
+@dataclass(frozen=True)
+class DeadlineEntry:
+    deadline: date
+    sheet: str
+    row: int
+    task: str
+    responsible: str
+    status: str
+
+    def key(self) -> str:
+        # Перенос срока или переименование задачи — повод напомнить заново
+        return f"{self.sheet}|{self.row}|{self.deadline.isoformat()}|{self.task}"
+
+
+def _cell(row: list, col: int) -> str:
+    idx = col - MIRROR_FIRST_COL
+    return str(row[idx]).strip() if idx < len(row) and row[idx] is not None else ""
+
+
+class DeadlineIndex:
+    def __init__(self, sheets: dict[str, list[list]], today: date | None = None):
+        """sheets — название листа -> строки B–J начиная с 1-й (как в зеркале Editor)."""
+        today = today or today_moscow()
+        entries = []
+        for sheet, rows in sheets.items():
+            for row_num in range(FIRST_DATA_ROW, len(rows) + 1):
+                row = rows[row_num - 1]
+                task = _cell(row, 4)
+                status = _cell(row, 3)
+                if not task or DONE_STATUS in status:
+                    continue
+                deadline = normalize_deadline(_cell(row, 8), today)
+                if not deadline:
+                    continue
+                entries.append(DeadlineEntry(
+                    deadline=datetime.strptime(deadline, DATE_FORMAT).date(),
+                    sheet=sheet,
+                    row=row_num,
+                    task=task,
+                    responsible=_cell(row, 6),
+                    status=status,
+                ))
+        entries.sort(key=lambda e: (e.deadline, e.sheet, e.row))
+        self.entries = entries
+        self._deadlines = [e.deadline for e in entries]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def overdue(self, today: date) -> list[DeadlineEntry]:
+        return self.entries[:bisect.bisect_left(self._deadlines, today)]
+
+    def due_soon(self, today: date, days: int) -> list[DeadlineEntry]:
+        """Срок — сегодня или в ближайшие days дней."""
+        start = bisect.bisect_left(self._deadlines, today)
+        end = bisect.bisect_right(self._deadlines, today + timedelta(days=days))
+        return self.entries[start:end]
+
+
+class DigestState:
+    """Что уже отправлено в чаты: chat_id -> {ключ задачи и раздела: дата отправки}. Хранится в JSON-файле."""
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._sent: dict[str, dict[str, str]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self._sent = json.load(f)
+
+    def new_entries(self, chat_id: int, kind: str, entries: list[DeadlineEntry], today: date) -> list[DeadlineEntry]:
+        """Задачи, о которых сегодня в этот чат в этом разделе ещё не писали."""
+        sent = self._sent.get(str(chat_id), {})
+        return [e for e in entries if sent.get(f"{kind}|{e.key()}") != today.isoformat()]
+
+    def mark_sent(self, chat_id: int, kind: str, entries: list[DeadlineEntry], today: date) -> None:
+        with self._lock:
+            sent = self._sent.setdefault(str(chat_id), {})
+            for key in [k for k, day in sent.items() if day != today.isoformat()]:
+                del sent[key]
+            for e in entries:
+                sent[f"{kind}|{e.key()}"] = today.isoformat()
+            self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._sent, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def _format_section(title: str, entries: list[DeadlineEntry], show_sheet: bool) -> str:
+    lines = [f"{title} ({len(entries)}):"]
+    for e in entries[:DIGEST_SECTION_LIMIT]:
+        who = f" — {e.responsible}" if e.responsible else ""
+        where = f" [{e.sheet}]" if show_sheet else ""
+        lines.append(f"• «{e.task}»{who}, срок {e.deadline.strftime(DATE_FORMAT)}{where}")
+    if len(entries) > DIGEST_SECTION_LIMIT:
+        lines.append(f"…и ещё {len(entries) - DIGEST_SECTION_LIMIT}")
+    return "\n".join(lines)
+
+
+def format_digest(overdue: list[DeadlineEntry], due_soon: list[DeadlineEntry], days: int) -> str | None:
+    """Текст дайджеста для чата или None, если писать не о чем."""
+    if not overdue and not due_soon:
+        return None
+    show_sheet = len({e.sheet for e in [*overdue, *due_soon]}) > 1
+    sections = []
+    if overdue:
+        sections.append(_format_section("Просрочены", overdue, show_sheet))
+    if due_soon:
+        sections.append(_format_section(f"Срок в ближайшие {days} дн.", due_soon, show_sheet))
+    return "\n\n".join(sections)
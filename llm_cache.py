@@ -0,0 +1,85 @@
+"""
+Кэш ответов LLM для детерминированных вызовов (temperature=0).
+
+Ключ — хэш от модели, версии шаблона промпта, сегодняшней даты и нормализованного ввода,
+поэтому повторное и пересланное сообщение в тот же день отвечается из кэша без запроса к API.
+В памяти — LRU на max_size записей; при заданном path — дополнительно SQLite-файл на диске,
+который переживает перезапуск (записи старше disk_ttl удаляются при открытии).
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_input(text: str) -> str:
+    """Нормализация ввода для ключа: регистр и лишние пробелы не влияют на ответ."""
+    return " ".join((text or "").split()).casefold()
+
+
+class LLMCache:
+    def __init__(self, max_size: int = 2048, path: str | None = None, disk_ttl: float = 7 * 24 * 3600):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - disk_ttl,))
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Возвращает закэшированный ответ (новую копию) или None."""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            elif self._conn is not None:
+                row = self._conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row:
+                    value = row[0]
+                    self._remember(key, value)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, key: str, data) -> None:
+        value = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, value)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                        (key, value, time.time()),
+                    )
+
+    def _remember(self, key: str, value: str) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "size": len(self._memory),
+            }
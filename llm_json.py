@@ -0,0 +1,176 @@
+"""
+Разбор и проверка JSON-ответов LLM.
+
+parse_json — терпимый разбор: снимает markdown-обёртку, пропускает текст до и после JSON,
+убирает висячие запятые и дописывает закрывающие скобки у оборванного ответа.
+LLMSchema — JSON Schema ответа: отправляется в API как response_format (structured output)
+и проверяет разобранный ответ (validate), приводя мелкие расхождения типов («5» -> 5).
+"""
+import json
+import re
+from dataclasses import dataclass
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*(?:```|$)", re.S | re.I)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_DECODER = json.JSONDecoder()
+
+
+class SchemaError(ValueError):
+    """Ответ LLM не соответствует ожидаемой схеме."""
+
+
+@dataclass(frozen=True)
+class LLMSchema:
+    name: str
+    schema: dict
+    # strict — все поля обязательны и без лишних ключей (строгий режим structured output)
+    strict: bool = True
+    # Схема с корнем {list_key: [...]} принимает и голый массив (так его просит промпт)
+    list_key: str | None = None
+
+    def response_format(self) -> dict:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": self.name, "schema": self.schema, "strict": self.strict},
+        }
+
+    def validate(self, data):
+        if self.list_key and isinstance(data, list):
+            data = {self.list_key: data}
+        return validate(data, self.schema)
+
+
+def _close_truncated(text: str) -> str:
+    """Дописывает закрывающие кавычку и скобки, если ответ оборвался на середине."""
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    tail = '"' if in_string else ""
+    return _TRAILING_COMMA_RE.sub(r"\1", text.rstrip().rstrip(",") + tail + "".join(reversed(stack)))
+
+
+def parse_json(text: str):
+    """Первый JSON-объект или массив в ответе LLM. Если разобрать не удалось — ValueError."""
+    text = (text or "").strip()
+    fence = _FENCE_RE.search(text)
+    if fence:
+        text = fence.group(1)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    starts = [i for i, ch in enumerate(text) if ch in "{["]
+    for start in starts:
+        candidate = text[start:]
+        for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate), _close_truncated(candidate)):
+            try:
+                return _DECODER.raw_decode(attempt)[0]
+            except ValueError:
+                continue
+    raise ValueError(f"В ответе LLM нет JSON: {text[:200]!r}")
+
+
+def _types(schema: dict) -> list[str]:
+    types = schema.get("type", [])
+    return [types] if isinstance(types, str) else list(types)
+
+
+def _coerce(value, types: list[str]):
+    """Значение одного из типов types или SchemaError; числа и строки приводятся друг к другу."""
+    if value is None:
+        if "null" in types:
+            return None
+        raise SchemaError("null")
+    if isinstance(value, bool):
+        if "boolean" in types:
+            return value
+    elif isinstance(value, int) and ("integer" in types or "number" in types):
+        return value
+    elif isinstance(value, float):
+        if "number" in types:
+            return value
+        if "integer" in types and value.is_integer():
+            return int(value)
+    elif isinstance(value, str):
+        if "string" in types:
+            return value
+        stripped = value.strip()
+        if "integer" in types and re.fullmatch(r"-?\d+", stripped):
+            return int(stripped)
+        if "boolean" in types and stripped.lower() in ("true", "false"):
+            return stripped.lower() == "true"
+        if "null" in types and stripped.lower() in ("", "null", "none"):
+            return None
+    elif isinstance(value, dict) and "object" in types:
+        return value
+    elif isinstance(value, list) and "array" in types:
+        return value
+    if "string" in types and isinstance(value, (int, float)):
+        return str(value)
+    if "array" in types:
+        # Одно значение вместо массива из одного элемента
+        return [value]
+    raise SchemaError(f"ожидался {'/'.join(types)}, получено {type(value).__name__}")
+
+
+def validate(data, schema: dict, path: str = "$"):
+    """
+    Проверяет data по подмножеству JSON Schema (type, enum, properties, required,
+    additionalProperties, items) и возвращает приведённую копию. Лишние ключи при
+    additionalProperties=false отбрасываются, неподходящие элементы массивов — тоже.
+    """
+    types = _types(schema)
+    try:
+        value = _coerce(data, types) if types else data
+    except SchemaError as e:
+        raise SchemaError(f"{path}: {e}") from None
+    if value is None:
+        return None
+    if "enum" in schema:
+        if isinstance(value, str):
+            value = value.strip().lower()
+        if value not in schema["enum"]:
+            if "null" in types:
+                return None
+            raise SchemaError(f"{path}: {value!r} не из {schema['enum']}")
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        extra = schema.get("additionalProperties", True)
+        result = {}
+        for key, item in value.items():
+            if key in properties:
+                result[key] = validate(item, properties[key], f"{path}.{key}")
+            elif isinstance(extra, dict):
+                result[key] = validate(item, extra, f"{path}.{key}")
+            elif extra:
+                result[key] = item
+        for key in schema.get("required", []):
+            if key not in result:
+                # Необязательное по смыслу поле (допускает null) LLM мог просто не вернуть
+                if "null" in _types(properties.get(key, {})):
+                    result[key] = None
+                else:
+                    raise SchemaError(f"{path}: нет поля {key!r}")
+        return result
+    if isinstance(value, list) and "items" in schema:
+        result = []
+        for i, item in enumerate(value):
+            try:
+                result.append(validate(item, schema["items"], f"{path}[{i}]"))
+            except SchemaError:
+                continue
+        return result
+    return value
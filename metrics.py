@@ -0,0 +1,207 @@
+"""
+Метрики задержек и стоимости: где тратится время при обработке сообщения и сколько токенов уходит на LLM.
+
+span / timed замеряют этапы (проверка прав, разбор LLM, методы Editor, запросы к Sheets API);
+к каждому замеру добавляется чат, который сейчас обрабатывается (contextvar current_chat).
+Экспорт — текстовый формат Prometheus (serve / render_prometheus) и снимок в JSON для логов.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограммы задержек, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Чат, в контексте которого идёт обработка. В пул потоков не передаётся сам по себе:
+# вызовы в executor нужно запускать через contextvars.copy_context().run (см. bot.run_blocking)
+current_chat: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_chat", default=None)
+
+
+class _Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    def __init__(self, namespace: str = "bot"):
+        self.namespace = namespace
+        self._spans: dict[tuple[str, tuple], _Histogram] = {}
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    def _labels(self, labels: dict) -> tuple:
+        if "chat" not in labels:
+            labels = {**labels, "chat": current_chat.get()}
+        return _label_key(labels)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._spans.get(key)
+            if histogram is None:
+                histogram = self._spans[key] = _Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Замер этапа; ошибка тоже учитывается (с меткой error=1)."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.perf_counter() - started_at, error=1, **labels)
+            raise
+        self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timed(self, name: str):
+        """Декоратор: замер вызова функции (обычной или async)."""
+        def decorate(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record_llm_usage(self, model: str, usage) -> None:
+        """Токены из response.usage (OpenAI SDK); провайдер может их не вернуть."""
+        self.inc("llm_requests", model=model)
+        if usage is None:
+            return
+        for kind in ("prompt_tokens", "completion_tokens"):
+            tokens = getattr(usage, kind, None)
+            if tokens:
+                self.inc("llm_tokens", tokens, model=model, type=kind.removesuffix("_tokens"))
+
+    def snapshot(self) -> dict:
+        """Агрегаты по этапам, чатам и моделям — для JSON-логов."""
+        with self._lock:
+            spans = [
+                {
+                    "name": name,
+                    **dict(labels),
+                    "count": h.count,
+                    "avg_ms": round(h.total / h.count * 1000, 1),
+                    "max_ms": round(h.max * 1000, 1),
+                }
+                for (name, labels), h in sorted(self._spans.items())
+            ]
+            counters = [
+                {"name": name, **dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        return {"spans": spans, "counters": counters}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False)
+
+    def render_prometheus(self) -> str:
+        span_metric = f"{self.namespace}_span_seconds"
+        lines = [f"# TYPE {span_metric} histogram"]
+        with self._lock:
+            for (name, labels), h in sorted(self._spans.items()):
+                labels = (("span", name), *labels)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.buckets):
+                    cumulative += count
+                    lines.append(f"{span_metric}_bucket{_format_labels(labels, (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{span_metric}_bucket{_format_labels(labels, (('le', '+Inf'),))} {h.count}")
+                lines.append(f"{span_metric}_sum{_format_labels(labels)} {h.total}")
+                lines.append(f"{span_metric}_count{_format_labels(labels)} {h.count}")
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{self.namespace}_{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """HTTP-эндпоинт /metrics для Prometheus в фоновом потоке."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+def instrument(prefix: str):
+    """
+    Декоратор класса: замер всех публичных методов (в том числе staticmethod)
+    под именами «prefix.метод».
+    """
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_"):
+                continue
+            if isinstance(value, staticmethod):
+                setattr(cls, attr, staticmethod(metrics.timed(f"{prefix}.{attr}")(value.__func__)))
+            elif inspect.isfunction(value):
+                setattr(cls, attr, metrics.timed(f"{prefix}.{attr}")(value))
+        return cls
+    return decorate
+
+
+metrics = Metrics()
@@ -0,0 +1,139 @@
+"""
+Хранилище задач, ожидающих срока (ключ — (chat_id, user_id)).
+
+Два варианта с одинаковым интерфейсом get / set / pop / sweep:
+  - MemoryPendingStore — в памяти, LRU с ограничением размера и TTL;
+  - SqlitePendingStore — в SQLite-файле, переживает перезапуск бота.
+Записи старше ttl секунд считаются истёкшими и удаляются при обращении и при sweep().
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PendingKey = tuple[int, int]
+
+
+class MemoryPendingStore:
+    def __init__(self, ttl: float = 86400, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (value, время записи); порядок — от давно использованных к недавним
+        self._items: OrderedDict[PendingKey, tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: PendingKey) -> dict | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if time.time() - item[1] > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: PendingKey, value: dict) -> None:
+        with self._lock:
+            self._items[key] = (value, time.time())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: PendingKey) -> dict | None:
+        with self._lock:
+            item = self._items.pop(key, None)
+            return item[0] if item else None
+
+    def sweep(self) -> int:
+        """Удаляет истёкшие записи, возвращает их число."""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [key for key, (_, stored_at) in self._items.items() if stored_at < deadline]
+            for key in expired:
+                del self._items[key]
+        return len(expired)
+
+
+class SqlitePendingStore:
+    def __init__(self, path: str, ttl: float = 86400, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL и synchronous=NORMAL: фиксация без fsync на каждую запись (журнал сбрасывается при checkpoint)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS pending_tasks (
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, user_id)
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS pending_tasks_updated_at ON pending_tasks (updated_at)"
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending_tasks").fetchone()[0]
+
+    def get(self, key: PendingKey) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, updated_at FROM pending_tasks WHERE chat_id = ? AND user_id = ?",
+                key,
+            ).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > self.ttl:
+            self.pop(key)
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: PendingKey, value: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_tasks (chat_id, user_id, value, updated_at) VALUES (?, ?, ?, ?)",
+                (*key, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            # Ограничение размера: вытесняем самые давние записи
+            self._conn.execute(
+                """DELETE FROM pending_tasks WHERE rowid IN (
+                    SELECT rowid FROM pending_tasks ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_size,),
+            )
+
+    def pop(self, key: PendingKey) -> dict | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM pending_tasks WHERE chat_id = ? AND user_id = ?", key
+            ).fetchone()
+            self._conn.execute("DELETE FROM pending_tasks WHERE chat_id = ? AND user_id = ?", key)
+        return json.loads(row[0]) if row else None
+
+    def sweep(self) -> int:
+        """Удаляет истёкшие записи, возвращает их число."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM pending_tasks WHERE updated_at < ?", (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
+
+
+def create_pending_store(backend: str = "memory", path: str = "pending_tasks.sqlite3", ttl: float = 86400, max_size: int = 10000):
+    """Создаёт хранилище по названию бэкенда: "memory" или "sqlite"."""
+    if backend == "memory":
+        return MemoryPendingStore(ttl=ttl, max_size=max_size)
+    if backend == "sqlite":
+        return SqlitePendingStore(path, ttl=ttl, max_size=max_size)
+    raise ValueError(f"Неизвестный бэкенд хранилища ожидающих задач: {backend}")
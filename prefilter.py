@@ -0,0 +1,133 @@
+"""
+Локальный предфильтр сообщений из рабочего чата.
+
+Отсекает очевидные «не задачи» («спасибо», «ок», эмодзи, приветствия)
+до обращения к LLM (Editor.extract_task_from_chat_message). Эвристики можно дополнить
+небольшой локальной моделью: любой callable text -> вероятность того, что это задача.
+"""
+import importlib
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+# Реплики, которые почти никогда не бывают постановкой задачи
+ACK_WORDS = {
+    "ок", "окей", "ok", "okay", "хорошо", "хор", "ладно", "понял", "поняла", "поняли",
+    "принял", "приняла", "приняли", "принято", "спасибо", "спс", "благодарю", "да", "нет",
+    "ага", "угу", "супер", "отлично", "класс", "круто", "норм", "согласен", "согласна",
+    "договорились", "понятно", "ясно", "добро", "есть", "сделано", "готово", "привет",
+    "здравствуйте", "доброе", "утро", "добрый", "день", "вечер", "всем", "коллеги",
+    "большое", "всё", "все", "good", "thanks", "+", "++",
+}
+
+# Слова и обороты, по которым поручение угадывается без глагола в повелительном наклонении
+TASK_MARKERS = (
+    "надо", "нужно", "необходимо", "требуется", "поручаю", "прошу", "просьба", "займись",
+    "займитесь", "срок", "дедлайн", "до конца", "к понедельнику", "к вторнику", "к среде",
+    "к четвергу", "к пятнице", "к субботе", "к воскресенью", "завтра", "послезавтра",
+    "сегодня", "ответственн", "задача", "задачу", "поручение",
+)
+
+# Частые глаголы в повелительном наклонении (ед. ч.), множественное ловится по -ите/-йте
+IMPERATIVE_VERBS = {
+    "сделай", "подготовь", "отправь", "позвони", "свяжись", "проверь", "напиши", "закажи",
+    "купи", "согласуй", "организуй", "узнай", "реши", "сдай", "пришли", "скинь", "найди",
+    "уточни", "посчитай", "оформи", "закрой", "обнови", "добавь", "убери", "перенеси",
+    "собери", "распечатай", "передай", "забронируй", "договорись", "подпиши", "оплати",
+    "выясни", "составь", "заполни", "запусти", "почини", "исправь", "разберись", "встреть",
+}
+
+_WORD_RE = re.compile(r"[0-9a-zа-яё+]+", re.IGNORECASE)
+_LETTER_RE = re.compile(r"[a-zа-яё]", re.IGNORECASE)
+_DATE_RE = re.compile(r"\b\d{1,2}[./]\d{1,2}(?:[./]\d{2,4})?\b")
+_PLURAL_IMPERATIVE_RE = re.compile(r"[а-яё]{2,}(?:ите|йте)$")
+# Инфинитив («сделать», «позвонить», «привезти», «помочь», «разобраться») — обычная форма поручения в чате
+_INFINITIVE_RE = re.compile(r"[а-яё]{2,}(?:ть|ти|чь)(?:ся|сь)?$")
+
+
+@dataclass
+class PrefilterDecision:
+    # True — сообщение нужно отправить в LLM; False — отброшено локально
+    is_candidate: bool
+    # Уверенность в том, что это НЕ задача (0..1)
+    confidence: float
+    reason: str
+
+
+@dataclass
+class PrefilterStats:
+    checked: int = 0
+    skipped: int = 0
+
+    @property
+    def passed(self) -> int:
+        return self.checked - self.skipped
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.checked if self.checked else 0.0
+
+
+def load_model(spec: str) -> Callable[[str], float]:
+    """
+    Загружает локальную модель по строке вида «module:function».
+    Функция принимает текст и возвращает вероятность того, что в нём есть задача.
+    """
+    module_name, _, attr = spec.partition(":")
+    if not module_name or not attr:
+        raise ValueError(f"Ожидается строка вида module:function, получено: {spec!r}")
+    module = importlib.import_module(module_name)
+    return getattr(module, attr)
+
+
+class TaskPrefilter:
+    """
+    Локальный классификатор «задача / не задача».
+    Сообщение отбрасывается, только если уверенность в том, что это не задача, не ниже threshold.
+    """
+
+    def __init__(self, threshold: float = 0.9, model: Callable[[str], float] | None = None):
+        self.threshold = threshold
+        self.model = model
+        self.stats = PrefilterStats()
+        self._lock = threading.Lock()
+
+    def _heuristic(self, text: str) -> tuple[float, str]:
+        """Возвращает (уверенность, что это НЕ задача; причина)."""
+        normalized = text.strip().lower()
+        if not _LETTER_RE.search(normalized):
+            return 0.99, "нет букв"
+        words = _WORD_RE.findall(normalized)
+        if "@" in normalized or _DATE_RE.search(normalized):
+            return 0.0, "упоминание или дата"
+        if any(marker in normalized for marker in TASK_MARKERS):
+            return 0.0, "маркер поручения"
+        if any(w in IMPERATIVE_VERBS or _PLURAL_IMPERATIVE_RE.search(w) for w in words):
+            return 0.0, "повелительное наклонение"
+        if words and all(w in ACK_WORDS for w in words):
+            return 0.98, "благодарность / подтверждение"
+        if any(_INFINITIVE_RE.search(w) for w in words):
+            return 0.0, "инфинитив"
+        if len(words) <= 3:
+            # Короткое поручение («Петров, отчёт») тоже бывает — решает LLM или локальная модель
+            return 0.7, "короткая реплика без поручения"
+        if normalized.endswith("?"):
+            return 0.8, "вопрос без поручения"
+        return 0.5, "нет явных признаков"
+
+    def check(self, text: str) -> PrefilterDecision:
+        confidence, reason = self._heuristic(text or "")
+        if self.model is not None and 0.0 < confidence < self.threshold:
+            confidence = 1.0 - float(self.model(text))
+            reason = "локальная модель"
+        decision = PrefilterDecision(
+            is_candidate=confidence < self.threshold,
+            confidence=confidence,
+            reason=reason,
+        )
+        with self._lock:
+            self.stats.checked += 1
+            if not decision.is_candidate:
+                self.stats.skipped += 1
+        return decision
@@ -0,0 +1,155 @@
+"""
+Ограничение частоты запросов к внешним API (Google Sheets, LLM) и повторы при сбоях:
+ведро токенов под квоты, экспоненциальные повторы с разбросом для 429/5xx
+и автомат защиты (circuit breaker), который перестаёт слать запросы в лежащий сервис.
+"""
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Потокобезопасный «ведро токенов»: rate_per_minute запросов в минуту
+    с допустимым всплеском до capacity запросов подряд.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 6)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Ждёт (блокируя поток), пока не освободится нужное число токенов."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class LimiterGroup:
+    """Несколько ограничителей сразу: например, лимит таблицы и общий лимит проекта."""
+
+    def __init__(self, *limiters):
+        self.limiters = [limiter for limiter in limiters if limiter is not None]
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        for limiter in self.limiters:
+            limiter.acquire(tokens)
+
+    def available(self) -> float:
+        return min((limiter.available() for limiter in self.limiters), default=float("inf"))
+
+
+class CircuitOpenError(Exception):
+    """Сервис недоступен: после серии ошибок запросы временно не отправляются."""
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд «размыкается» на reset_timeout секунд:
+    вызовы сразу завершаются CircuitOpenError, не нагружая сервис. Затем пропускается
+    один пробный вызов: успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    def __init__(self, name: str = "", failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def retry_call(
+    func,
+    *args,
+    limiter=None,
+    breaker: CircuitBreaker | None = None,
+    is_retryable=lambda exc: False,
+    max_attempts: int = 5,
+    base_delay: float = 1.0,
+    max_delay: float = 32.0,
+    **kwargs,
+):
+    """
+    Вызывает func с учётом лимита и автомата защиты. Ошибки, для которых is_retryable(exc)
+    истинно (429, 5xx, обрывы соединения), повторяются с экспоненциальной задержкой
+    и случайным разбросом (full jitter), но не более max_attempts попыток.
+    """
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Сервис {breaker.name} временно недоступен")
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                # Ошибка в самом запросе (400, 404...) — сервис жив, цепь не размыкаем
+                if breaker is not None:
+                    breaker.record_success()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
@@ -0,0 +1,164 @@
+"""
+Маршрутизация задач по таблицам: чат (или категория задачи) -> таблица и лист.
+
+EditorPool держит по одному Editor на таблицу. Все Editor используют общие credentials
+и один клиент gspread (одну HTTP-сессию). Лимит запросов у каждой таблицы свой, и ещё
+один общий — квота Sheets API сервисного аккаунта на все таблицы.
+"""
+import json
+import os
+import threading
+
+import gspread
+from google.oauth2.service_account import Credentials
+
+from ratelimit import LimiterGroup, TokenBucket
+from script import DRIVE_METADATA_SCOPE, SCOPES, Editor
+
+# Маршрут: (spreadsheet_id, название листа или None — первый лист)
+Route = tuple[str, str | None]
+
+
+class EditorPool:
+    def __init__(
+        self,
+        credentials_path: str,
+        requests_per_minute: float = 60,
+        user_requests_per_minute: float = 60,
+        queue_path_template: str | None = None,
+        **editor_kwargs,
+    ):
+        """
+        requests_per_minute — лимит запросов к каждой таблице отдельно;
+        user_requests_per_minute — общий лимит на все таблицы: они открыты одним сервисным
+        аккаунтом, а квота Sheets API считается на пользователя, а не на таблицу.
+        queue_path_template — путь очереди отложенной записи, например
+        "insert_queue.{spreadsheet_id}.json"; None — без очереди на диске.
+        """
+        self.credentials_path = credentials_path
+        self.requests_per_minute = requests_per_minute
+        self.queue_path_template = queue_path_template
+        self.editor_kwargs = editor_kwargs
+        self.user_limiter = TokenBucket(user_requests_per_minute)
+        self._client = None
+        self._editors: dict[str, Editor] = {}
+        # Короткая блокировка словарей; открытие таблицы (сетевые запросы) идёт под блокировкой
+        # этой таблицы из _opening, чтобы разные таблицы открывались параллельно
+        self._lock = threading.Lock()
+        self._opening: dict[str, threading.Lock] = {}
+
+    def _gspread_client(self):
+        if self._client is None:
+            scopes = SCOPES + [DRIVE_METADATA_SCOPE] if self.editor_kwargs.get("drive_version_check") else SCOPES
+            credentials = Credentials.from_service_account_file(self.credentials_path, scopes=scopes)
+            self._client = gspread.authorize(credentials)
+        return self._client
+
+    def get(self, spreadsheet_id: str) -> Editor:
+        """Editor для таблицы; создаётся (и открывает таблицу) при первом обращении."""
+        with self._lock:
+            editor = self._editors.get(spreadsheet_id)
+            if editor is not None:
+                return editor
+            opening = self._opening.setdefault(spreadsheet_id, threading.Lock())
+            gspread_client = self._gspread_client()
+        with opening:
+            editor = self._editors.get(spreadsheet_id)
+            if editor is None:
+                queue_path = None
+                if self.queue_path_template:
+                    queue_path = self.queue_path_template.format(spreadsheet_id=spreadsheet_id)
+                editor = Editor(
+                    self.credentials_path,
+                    spreadsheet_id,
+                    queue_path=queue_path,
+                    gspread_client=gspread_client,
+                    limiter=LimiterGroup(TokenBucket(self.requests_per_minute), self.user_limiter),
+                    **self.editor_kwargs,
+                )
+                with self._lock:
+                    self._editors[spreadsheet_id] = editor
+            return editor
+
+    def editors(self) -> list[Editor]:
+        """Уже открытые Editor (для фоновой записи очередей и обходов)."""
+        with self._lock:
+            return list(self._editors.values())
+
+
+def _parse_route(value) -> Route:
+    if isinstance(value, str):
+        return value, None
+    return value["spreadsheet_id"], value.get("sheet")
+
+
+class ChatRouter:
+    """
+    Выбирает таблицу и лист для задачи. Порядок: маршрут по категории задачи,
+    затем по чату, затем маршрут по умолчанию.
+    """
+
+    def __init__(
+        self,
+        chat_routes: dict[int, Route] | None = None,
+        category_routes: dict[str, Route] | None = None,
+        default: Route | None = None,
+    ):
+        self.chat_routes = chat_routes or {}
+        self.category_routes = {k.strip().lower(): v for k, v in (category_routes or {}).items()}
+        self.default = default
+
+    @classmethod
+    def from_config(cls, raw: str | None, default_spreadsheet_id: str | None = None) -> "ChatRouter":
+        """
+        raw — JSON (строка или путь к файлу) вида
+        {"chats": {"-100123": "spreadsheet_id", "-100456": {"spreadsheet_id": "...", "sheet": "Объект 2"}},
+         "categories": {"Электрика": {"spreadsheet_id": "...", "sheet": "Электрика"}},
+         "default": "spreadsheet_id"}
+        Без конфигурации все чаты пишут в default_spreadsheet_id.
+        """
+        config = {}
+        if raw:
+            raw = raw.strip()
+            if not raw.startswith("{") and os.path.exists(raw):
+                with open(raw, encoding="utf-8") as f:
+                    config = json.load(f)
+            else:
+                config = json.loads(raw)
+        default = config.get("default")
+        if default is None and default_spreadsheet_id:
+            default = default_spreadsheet_id
+        return cls(
+            chat_routes={int(k): _parse_route(v) for k, v in config.get("chats", {}).items()},
+            category_routes={k: _parse_route(v) for k, v in config.get("categories", {}).items()},
+            default=_parse_route(default) if default else None,
+        )
+
+    def route(self, chat_id: int, category: str | None = None) -> Route | None:
+        if category:
+            route = self.category_routes.get(category.strip().lower())
+            if route:
+                return route
+        return self.chat_routes.get(chat_id, self.default)
+
+    def chats_for(self, spreadsheet_id: str, known_chats=()) -> dict[int, str | None]:
+        """
+        Чаты, задачи которых пишутся в таблицу spreadsheet_id: {chat_id: лист или None — все листы}.
+        Чаты без своего маршрута берутся из known_chats, если маршрут по умолчанию ведёт в эту таблицу.
+        """
+        chats = {
+            chat_id: sheet
+            for chat_id, (route_spreadsheet_id, sheet) in self.chat_routes.items()
+            if route_spreadsheet_id == spreadsheet_id
+        }
+        if self.default and self.default[0] == spreadsheet_id:
+            for chat_id in known_chats:
+                if chat_id not in self.chat_routes:
+                    chats[chat_id] = self.default[1]
+        return chats
+
+    def spreadsheet_ids(self) -> set[str]:
+        routes = [*self.chat_routes.values(), *self.category_routes.values()]
+        if self.default:
+            routes.append(self.default)
+        return {spreadsheet_id for spreadsheet_id, _ in routes}
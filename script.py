@@ -1,41 +1,496 @@
 
 import gspread
 import json
+import logging
 from datetime import datetime
 from google.oauth2.service_account import Credentials
-from openai import OpenAI
-from dotenv import load_dotenv
+from gspread.utils import ValueInputOption
+from openai import APIConnectionError, APIStatusError, APITimeoutError, OpenAI
 import os
+import threading
+import time
 from zoneinfo import ZoneInfo
 
-load_dotenv()
-api_key = os.getenv("VSE_GPT_API")
+from deadline_parser import normalize_deadline, parse_follow_up
+from llm_cache import LLMCache, normalize_input
+from llm_json import LLMSchema, parse_json
+from metrics import instrument, metrics
+from ratelimit import CircuitBreaker, CircuitOpenError, TokenBucket, retry_call
+from task_index import TaskIndex
+
+# Клиент OpenAI и кэш ответов LLM создаются при первом обращении (get_client, get_response_cache),
+# а не при импорте. Переменные окружения из .env загружает точка входа (bot.py).
+_client: OpenAI | None = None
+_client_lock = threading.Lock()
+_response_cache: LLMCache | None = None
+_response_cache_ready = False
+
+
+def get_client() -> OpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(
+                api_key=os.getenv("VSE_GPT_API"), # ваш ключ в VseGPT после регистрации
+                base_url="https://api.vsegpt.ru/v1",
+                max_retries=0,  # повторы делает retry_call, с общим лимитом и circuit breaker
+            )
+        return _client
+
+
+def get_response_cache() -> LLMCache | None:
+    """
+    Кэш ответов LLM (все вызовы с temperature=0); None, если LLM_CACHE_ENABLED=0.
+    LLM_CACHE_PATH включает хранение на диске.
+    """
+    global _response_cache, _response_cache_ready
+    with _client_lock:
+        if not _response_cache_ready:
+            if os.getenv("LLM_CACHE_ENABLED", "1") != "0":
+                _response_cache = LLMCache(
+                    max_size=int(os.getenv("LLM_CACHE_SIZE", "2048")),
+                    path=os.getenv("LLM_CACHE_PATH") or None,
+                )
+            _response_cache_ready = True
+        return _response_cache
+
+
+def __getattr__(name: str):
+    # Совместимость: «from script import client» по-прежнему работает, но клиент создаётся лениво
+    if name == "client":
+        return get_client()
+    if name == "response_cache":
+        return get_response_cache()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-client = OpenAI(
-    api_key=api_key, # ваш ключ в VseGPT после регистрации
-    base_url="https://api.vsegpt.ru/v1",
-)
+
+logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Нужен только для проверки версии файла через Drive API (drive_version_check)
+DRIVE_METADATA_SCOPE = 'https://www.googleapis.com/auth/drive.metadata.readonly'
+# Локальное зеркало листа хранит столбцы B–J (номер, статус, ..., комментарии)
+MIRROR_FIRST_COL = 2
+MIRROR_LAST_COL = 10
+# Таблица задач, которую видит LLM и возвращает scan_table: столбцы B–I
+TABLE_LAST_COL = 9
+# Столбцы, по которым строится поисковый индекс: Задача, Категория, Ответственный, Срок
+INDEX_COLS = (4, 5, 6, 8)
+# Первая строка с данными (строка 3 — заголовки)
+FIRST_DATA_ROW = 4
+# Столбцы-«отпечатки» строки: Статус и Срок чаще всего правят в таблице руками.
+# По ним при обновлении зеркала находятся изменённые строки; правки в других столбцах
+# подхватывает периодическое полное перечитывание (full_resync_interval).
+FINGERPRINT_COLS = (3, 8)
+LLM_MODEL = "openai/gpt-5-mini"
+TRANSCRIBE_MODEL = "stt-openai/whisper-v3-turbo"
+# Версия шаблонов промптов: увеличить при любом изменении текста промптов, чтобы сбросить кэш
+PROMPT_VERSION = 1
+
+
+# Structured output: схема ответа передаётся в API (response_format=json_schema).
+# Если эндпоинт её не принимает, флаг сбрасывается при первом отказе и дальше схема проверяется только локально.
+structured_output = os.getenv("LLM_STRUCTURED_OUTPUT", "1") != "0"
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Общий лимит запросов к LLM-провайдеру и автомат защиты на случай его недоступности
+llm_limiter = TokenBucket(float(os.getenv("LLM_REQUESTS_PER_MINUTE", "120")))
+llm_breaker = CircuitBreaker("LLM")
+
 
+def _is_retryable_llm_error(exc: Exception) -> bool:
+    if isinstance(exc, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code in RETRYABLE_STATUS_CODES
 
+
+def _is_retryable_sheets_error(exc: Exception) -> bool:
+    if isinstance(exc, gspread.exceptions.APIError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """
+    Временный сбой LLM или Sheets (сеть, 429/5xx, открытый автомат защиты): работу стоит
+    повторить позже. Остальные ошибки (400, ответ не по схеме) при повторе не исчезнут.
+    """
+    return isinstance(exc, CircuitOpenError) or _is_retryable_llm_error(exc) or _is_retryable_sheets_error(exc)
+
+
+def _is_response_format_error(exc: APIStatusError) -> bool:
+    """400/422 из-за response_format (а не, например, из-за слишком длинного промпта)."""
+    if exc.status_code not in (400, 422):
+        return False
+    text = f"{exc.message} {json.dumps(exc.body, ensure_ascii=False, default=str)}".lower()
+    return any(hint in text for hint in ("response_format", "json_schema", "structured output", "structured_output"))
+
+
+def _llm_cache_key(method: str, today: str, *inputs) -> str:
+    return LLMCache.make_key(LLM_MODEL, PROMPT_VERSION, method, today, *inputs)
+
+
+def _ask_llm_json(client: OpenAI, prompt: str, cache_key: str | None = None, schema: LLMSchema | None = None):
+    """
+    Отправляет промпт в LLM и разбирает ответ как JSON (llm_json.parse_json).
+    schema — ожидаемая схема ответа: передаётся в API как structured output (если включён)
+    и проверяет ответ (SchemaError, если ответ ей не соответствует).
+    Если передан cache_key, ответ берётся из кэша ответов (get_response_cache) и сохраняется в него.
+    """
+    global structured_output
+    response_cache = get_response_cache() if cache_key else None
+    if response_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            metrics.inc("llm_cache_hits", model=LLM_MODEL)
+            return schema.validate(cached) if schema else cached
+    request = {
+        "model": LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+    }
+    if schema and structured_output:
+        request["response_format"] = schema.response_format()
+    call = lambda: retry_call(
+        client.chat.completions.create,
+        limiter=llm_limiter,
+        breaker=llm_breaker,
+        is_retryable=_is_retryable_llm_error,
+        **request,
+    )
+    with metrics.span("llm.request", model=LLM_MODEL):
+        try:
+            response = call()
+        except APIStatusError as e:
+            if "response_format" not in request or not _is_response_format_error(e):
+                raise
+            del request["response_format"]
+            response = call()
+            # Без response_format запрос прошёл — значит, провайдер не поддерживает structured output
+            logger.warning("LLM не поддерживает structured output (%s), дальше без него", e.status_code)
+            structured_output = False
+    metrics.record_llm_usage(LLM_MODEL, getattr(response, "usage", None))
+    data = parse_json(response.choices[0].message.content)
+    if schema:
+        data = schema.validate(data)
+    if response_cache:
+        response_cache.put(cache_key, data)
+    return data
+
+
+# Поля задачи, которые LLM извлекает из сообщения рабочего чата
+CHAT_TASK_FIELDS = """  "task": "Краткое название задачи (1-10 слов), чёткая формулировка.",
+  "responsible": "Имя ответственного в именительном падеже. Если не указано — null.",
+  "deadline": "Дата в формате дд.мм.гггг (относительные формулировки переведи относительно сегодня). Если не указано — null.",
+  "priority": "«высокий», «средний» или «низкий». Если не указано — null.",
+  "comments": "Оставь пустым, только если пользователь напрямую не просит что-то отметить в комментарии",
+  "category": "Категория задачи, если из контекста понятна. Иначе null."
+""".rstrip()
+
+
+_NULLABLE_STRING = {"type": ["string", "null"]}
+CHAT_TASK_PROPERTIES = {
+    "is_task": {"type": "boolean"},
+    "task": _NULLABLE_STRING,
+    "responsible": _NULLABLE_STRING,
+    "deadline": _NULLABLE_STRING,
+    "priority": _NULLABLE_STRING,
+    "comments": _NULLABLE_STRING,
+    "category": _NULLABLE_STRING,
+}
+CHAT_TASK_SCHEMA = LLMSchema(
+    "chat_task",
+    {
+        "type": "object",
+        "properties": CHAT_TASK_PROPERTIES,
+        "required": list(CHAT_TASK_PROPERTIES),
+        "additionalProperties": False,
+    },
+)
+CHAT_TASKS_BATCH_SCHEMA = LLMSchema(
+    "chat_tasks_batch",
+    {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"id": {"type": "integer"}, **CHAT_TASK_PROPERTIES},
+                    "required": ["id", *CHAT_TASK_PROPERTIES],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["results"],
+        "additionalProperties": False,
+    },
+    list_key="results",
+)
+ADD_TASK_SCHEMA = LLMSchema(
+    "add_task",
+    {
+        "type": "object",
+        "properties": {
+            "task": {"type": "string"},
+            "responsible": _NULLABLE_STRING,
+            "deadline": _NULLABLE_STRING,
+            "priority": _NULLABLE_STRING,
+            "comments": _NULLABLE_STRING,
+        },
+        "required": ["task", "responsible", "deadline", "priority", "comments"],
+        "additionalProperties": False,
+    },
+)
+FOLLOW_UP_SCHEMA = LLMSchema(
+    "follow_up",
+    {
+        "type": "object",
+        "properties": {
+            # Непонятное значение action приводится к null и считается «unclear»
+            "action": {"type": ["string", "null"], "enum": ["add", "decline", "unclear", None]},
+            "deadline": _NULLABLE_STRING,
+        },
+        "required": ["action", "deadline"],
+        "additionalProperties": False,
+    },
+)
+# Ключи changes — названия колонок конкретного листа, поэтому схема нестрогая
+SEARCH_UPDATE_SCHEMA = LLMSchema(
+    "search_update",
+    {
+        "type": "object",
+        "properties": {
+            "matched_rows": {"type": ["array", "null"], "items": {"type": "integer"}},
+            "changes": {"type": ["object", "null"], "additionalProperties": _NULLABLE_STRING},
+            "Ответ в чате": _NULLABLE_STRING,
+        },
+        "required": ["matched_rows", "changes", "Ответ в чате"],
+    },
+    strict=False,
+)
+
+
+def _chat_task_from_llm(data: dict) -> dict | None:
+    """Ответ LLM по одному сообщению чата -> dict для insert_info (без is_task) или None."""
+    if not isinstance(data, dict) or not data.get("is_task"):
+        return None
+    return {
+        "task": data.get("task") or "",
+        "responsible": data.get("responsible"),
+        # Срок, который не удалось разобрать как дату, считаем неуказанным — бот переспросит
+        "deadline": normalize_deadline(data.get("deadline")),
+        "priority": data.get("priority"),
+        "comments": data.get("comments"),
+        "category": data.get("category"),
+    }
+
+
+def _trim_row(values: list) -> list:
+    """Убирает пустые ячейки в конце строки — так же, как это делает Sheets API."""
+    end = len(values)
+    while end and values[end - 1] in ("", None):
+        end -= 1
+    return list(values[:end])
+
+
+# Форматы таблицы в промпте search_task_to_update и их описание для LLM
+TABLE_FORMAT_TITLES = {
+    "json": "Таблица задач (каждая строка с полем sheet_row — номер строки на листе):",
+    "jsonl": "Таблица задач (каждая строка с полем sheet_row — номер строки на листе):",
+    "tsv": (
+        "Таблица задач в формате TSV: первая строка — названия колонок, "
+        "первая колонка sheet_row — номер строки на листе. Пустые колонки опущены:"
+    ),
+}
+
+
+def format_table_for_llm(headers: list[str], data_rows: list[tuple[int, list]], table_format: str = "jsonl") -> str:
+    """
+    Кодирует строки таблицы для промпта. data_rows — пары (sheet_row, значения B–I).
+      - json  — массив объектов с отступами (исходный формат, самый «тяжёлый»);
+      - jsonl — по одному объекту на строку без отступов;
+      - tsv   — заголовки один раз, затем строки через табуляцию; колонки, пустые во всех
+                строках, и пустые ячейки в конце строки отбрасываются.
+    """
+    if table_format not in TABLE_FORMAT_TITLES:
+        raise ValueError(f"Неизвестный формат таблицы: {table_format}")
+    if table_format == "tsv":
+        used = [
+            j for j in range(len(headers))
+            if any(j < len(values) and str(values[j]).strip() for _, values in data_rows)
+        ]
+        lines = ["\t".join(["sheet_row"] + [headers[j] for j in used])]
+        for sheet_row, values in data_rows:
+            cells = [str(sheet_row)] + [
+                " ".join(str(values[j]).split()) if j < len(values) else "" for j in used
+            ]
+            lines.append("\t".join(_trim_row(cells)))
+        return "\n".join(lines)
+    rows = []
+    for sheet_row, values in data_rows:
+        row_dict = {"sheet_row": sheet_row}
+        for j, header in enumerate(headers):
+            row_dict[header] = values[j] if j < len(values) else ""
+        rows.append(row_dict)
+    if table_format == "json":
+        return json.dumps(rows, ensure_ascii=False, indent=2)
+    return "[\n" + ",\n".join(json.dumps(r, ensure_ascii=False) for r in rows) + "\n]"
+
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов в тексте. С установленным tiktoken — точный подсчёт (o200k_base),
+    без него — оценка по числу байт UTF-8 (кириллица ≈ 2 байта на символ).
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text.encode("utf-8")) // 4
+    return len(tiktoken.get_encoding("o200k_base").encode(text))
+
+
+def _index_text(mirror_row: list) -> str:
+    """Текст строки зеркала (B–J) для поискового индекса."""
+    return " ".join(str(mirror_row[col - MIRROR_FIRST_COL]) for col in INDEX_COLS)
+
+
+def _task_row_data(task_dict: dict) -> list[str]:
+    """Значения новой строки задачи для столбцов C–J."""
+    return [
+        "🔄",
+        (task_dict.get("task") or ""),
+        (task_dict.get("category") or ""),
+        (task_dict.get("responsible") or ""),
+        datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M"),  # дата/время добавления (распознаётся в Таблице как дата)
+        (task_dict.get("deadline") or ""),
+        (task_dict.get("priority") or ""),
+        (task_dict.get("comments") or ""),
+    ]
+
+
+@instrument("editor")
 class Editor:
-    def __init__(self, credentials_path, spreadsheet_id):
+    def __init__(
+        self,
+        credentials_path,
+        spreadsheet_id,
+        cache_ttl: float = 60,
+        queue_path=None,
+        gspread_client=None,
+        limiter=None,
+        full_resync_interval: float = 600,
+        drive_version_check: bool = False,
+    ):
         self.credentials_path = credentials_path
         self.spreadsheet_id = spreadsheet_id
+        # Ограничитель частоты запросов к этой таблице (ratelimit.TokenBucket / LimiterGroup) или None
+        self.limiter = limiter
+        # Автомат защиты: после серии 429/5xx запросы к таблице временно не отправляются
+        self.breaker = CircuitBreaker(f"Google Sheets {spreadsheet_id}")
+        # Сколько секунд локальное зеркало листа считается актуальным (0 — не кэшировать)
+        self.cache_ttl = cache_ttl
+        # Устаревшее зеркало не перечитывается целиком: сверяются столбцы FINGERPRINT_COLS
+        # и дочитываются только изменённые строки. Целиком — раз в full_resync_interval секунд.
+        self.full_resync_interval = full_resync_interval
+        # Перед сверкой спрашивать у Drive API время изменения файла: не изменился — без чтения листа.
+        # Нужен доступ DRIVE_METADATA_SCOPE.
+        self.drive_version_check = drive_version_check
+        # Зеркала листов: название листа -> {"rows": строки B–J начиная с 1-й, "loaded_at": последняя
+        # сверка, "synced_at": последнее полное чтение, "version": время изменения файла по Drive}
+        self._mirrors: dict[str, dict] = {}
+        # Общая блокировка зеркал и очереди вставок: номера строк выдаются под ней
+        self._mirror_lock = threading.RLock()
+        # Очередь отложенных вставок (queue_insert): {"sheet": лист, "row": строка, "values": C–J}.
+        # Если задан queue_path, очередь хранится на диске и восстанавливается при запуске.
+        self.queue_path = queue_path
+        self._insert_queue: list[dict] = self._load_insert_queue()
+        # Запись очереди не должна пересекаться с правкой/очисткой ещё не записанных строк
+        self._flush_lock = threading.Lock()
+        # Кэш метаданных: название листа -> объект Worksheet (в порядке листов в таблице)
+        self._worksheets: dict[str, gspread.Worksheet] = {}
+        self._metadata_lock = threading.Lock()
 
-        credentials = Credentials.from_service_account_file(
-            credentials_path,
-            scopes=SCOPES
-        )
-        self.client = gspread.authorize(credentials)
-        self.spreadsheet = self.client.open_by_key(spreadsheet_id)
-        self.sheet = self.spreadsheet.sheet1
+        if gspread_client is None:
+            # Общий клиент (и HTTP-сессию) можно передать извне — см. routing.EditorPool
+            credentials = Credentials.from_service_account_file(
+                credentials_path,
+                scopes=SCOPES + [DRIVE_METADATA_SCOPE] if drive_version_check else SCOPES
+            )
+            gspread_client = gspread.authorize(credentials)
+        self.client = gspread_client
+        self.spreadsheet = self._call(self.client.open_by_key, spreadsheet_id)
+        self.refresh_metadata()
+        # Первый лист — как spreadsheet.sheet1, но без отдельного запроса метаданных
+        self.sheet = next(iter(self._worksheets.values()))
 
-    def get_sheet_names(self) -> list[str]:
-        """Возвращает список названий всех листов таблицы (для динамического выбора объекта)."""
-        worksheets = self.spreadsheet.worksheets()
-        return [ws.title for ws in worksheets]
+    def _call(self, func, *args, **kwargs):
+        """
+        Сетевой вызов gspread с учётом лимита запросов к таблице;
+        429 и 5xx повторяются с экспоненциальной задержкой (ratelimit.retry_call).
+        """
+        with metrics.span("sheets.api", method=getattr(func, "__name__", "call")):
+            return retry_call(
+                func,
+                *args,
+                limiter=self.limiter,
+                breaker=self.breaker,
+                is_retryable=_is_retryable_sheets_error,
+                **kwargs,
+            )
+
+    def refresh_metadata(self) -> None:
+        """Перечитывает список листов (один запрос метаданных) и обновляет кэш Worksheet."""
+        worksheets = self._call(self.spreadsheet.worksheets)
+        with self._metadata_lock:
+            self._worksheets = {ws.title: ws for ws in worksheets}
+
+    def _worksheet(self, sheet_name=None):
+        """
+        Лист по названию из кэша метаданных (без сетевого запроса).
+        При промахе метаданные перечитываются один раз; если листа нет — WorksheetNotFound.
+        """
+        if not sheet_name:
+            return self.sheet
+        ws = self._worksheets.get(sheet_name)
+        if ws is None:
+            self.refresh_metadata()
+            ws = self._worksheets.get(sheet_name)
+            if ws is None:
+                raise gspread.exceptions.WorksheetNotFound(sheet_name)
+        return ws
+
+    def get_sheet_names(self, refresh: bool = False) -> list[str]:
+        """
+        Возвращает список названий всех листов таблицы (для динамического выбора объекта).
+        Берётся из кэша метаданных; refresh=True — перечитать список листов.
+        """
+        if refresh or not self._worksheets:
+            self.refresh_metadata()
+        return list(self._worksheets)
+
+    def read_all_sheets(self) -> dict[str, list[list[str]]]:
+        """
+        Строки B–J всех листов одним запросом values_batch_get (для фоновых обходов).
+        Возвращает {название листа: строки с 1-й}, строки дополнены до ширины B–J.
+        Список листов перечитывается при каждом обходе: лист могли добавить, переименовать или удалить.
+        """
+        names = self.get_sheet_names(refresh=True)
+        start_letter = self._col_number_to_letter(MIRROR_FIRST_COL)
+        end_letter = self._col_number_to_letter(MIRROR_LAST_COL)
+        width = MIRROR_LAST_COL - MIRROR_FIRST_COL + 1
+        ranges = ["'{}'!{}1:{}".format(name.replace("'", "''"), start_letter, end_letter) for name in names]
+        data = self._call(self.spreadsheet.values_batch_get, ranges)
+        result = {}
+        for name, value_range in zip(names, data.get("valueRanges", [])):
+            result[name] = [list(r) + [""] * (width - len(r)) for r in value_range.get("values", [])]
+        return result
+
+    def get_sheet_id(self, sheet_name=None) -> int:
+        """Числовой id листа (gid) из кэша метаданных."""
+        return self._worksheet(sheet_name).id
 
     def _col_number_to_letter(self, col: int) -> str:
         """Столбец по счёту (1, 2, 3...) в букву (A, B, C...)."""
@@ -46,13 +501,168 @@ class Editor:
             result = chr(65 + r) + result
         return result
 
+    def _sheet_key(self, sheet_name=None) -> str:
+        return sheet_name or self.sheet.title
+
+    def _mirror_rows(self, sheet_name=None) -> list[list[str]]:
+        """
+        Возвращает локальное зеркало листа (столбцы B–J, строки с 1-й).
+        Устаревшее (cache_ttl) зеркало обновляется по изменённым строкам (_refresh_mirror),
+        а целиком перечитывается одним запросом раз в full_resync_interval.
+        """
+        key = self._sheet_key(sheet_name)
+        with self._mirror_lock:
+            mirror = self._mirrors.get(key)
+            now = time.monotonic()
+            if mirror and now - mirror["loaded_at"] < self.cache_ttl:
+                return mirror["rows"]
+            sheet = self._worksheet(sheet_name)
+            if mirror and now - mirror["synced_at"] < self.full_resync_interval:
+                if self._refresh_mirror(sheet_name, sheet, mirror):
+                    return mirror["rows"]
+            version = self._drive_version()
+            start_letter = self._col_number_to_letter(MIRROR_FIRST_COL)
+            end_letter = self._col_number_to_letter(MIRROR_LAST_COL)
+            width = MIRROR_LAST_COL - MIRROR_FIRST_COL + 1
+            raw = self._call(sheet.get, f"{start_letter}1:{end_letter}")
+            rows = [list(r) + [""] * (width - len(r)) for r in raw]
+            index = TaskIndex()
+            for row_num in range(FIRST_DATA_ROW, len(rows) + 1):
+                index.upsert(row_num, _index_text(rows[row_num - 1]))
+            now = time.monotonic()
+            self._mirrors[key] = {"rows": rows, "loaded_at": now, "synced_at": now, "version": version, "index": index}
+            self._overlay_queued_inserts(sheet_name)
+            return rows
+
+    def _drive_version(self) -> str | None:
+        """Время последнего изменения файла таблицы по Drive API (если drive_version_check)."""
+        if not self.drive_version_check:
+            return None
+        try:
+            return self._call(self.spreadsheet.get_lastUpdateTime)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in (401, 403, 404):
+                raise
+            # Нет доступа к Drive API (не выдан DRIVE_METADATA_SCOPE) — работаем без проверки версии
+            logger.warning("Проверка версии таблицы через Drive API недоступна: %s", e)
+            self.drive_version_check = False
+            return None
+
+    def _refresh_mirror(self, sheet_name, sheet, mirror: dict) -> bool:
+        """
+        Обновляет зеркало по изменённым строкам: сверяет столбцы FINGERPRINT_COLS одним
+        batch_get и дочитывает вторым batch_get только отличающиеся строки.
+        Возвращает False, если изменилось слишком много — тогда лучше перечитать лист целиком.
+        """
+        version = self._drive_version()
+        if version is not None and version == mirror["version"]:
+            mirror["loaded_at"] = time.monotonic()
+            return True
+        rows = mirror["rows"]
+        width = MIRROR_LAST_COL - MIRROR_FIRST_COL + 1
+        columns = self._read_columns(sheet, FINGERPRINT_COLS)
+        total_rows = max([len(rows), *(len(column) for column in columns)])
+        # Строки из очереди вставок ещё не в таблице — их не сверяем
+        key = self._sheet_key(sheet_name)
+        queued = {item["row"] for item in self._insert_queue if item["sheet"] == key}
+        dirty = []
+        for row_num in range(1, total_rows + 1):
+            if row_num in queued:
+                continue
+            current = rows[row_num - 1] if row_num <= len(rows) else [""] * width
+            for column, col in zip(columns, FINGERPRINT_COLS):
+                value = column[row_num - 1] if row_num <= len(column) else ""
+                if current[col - MIRROR_FIRST_COL] != value:
+                    dirty.append(row_num)
+                    break
+        if len(dirty) > max(10, len(rows) // 4):
+            return False
+        if dirty:
+            # Подряд идущие строки читаются одним диапазоном
+            spans = []
+            for row_num in dirty:
+                if spans and spans[-1][1] == row_num - 1:
+                    spans[-1][1] = row_num
+                else:
+                    spans.append([row_num, row_num])
+            start_letter = self._col_number_to_letter(MIRROR_FIRST_COL)
+            end_letter = self._col_number_to_letter(MIRROR_LAST_COL)
+            ranges = [f"{start_letter}{first}:{end_letter}{last}" for first, last in spans]
+            fetched = self._call(sheet.batch_get, ranges)
+            while len(rows) < total_rows:
+                rows.append([""] * width)
+            for (first, last), values in zip(spans, fetched):
+                for row_num in range(first, last + 1):
+                    offset = row_num - first
+                    row = list(values[offset]) if offset < len(values) else []
+                    rows[row_num - 1] = row + [""] * (width - len(row))
+                    if row_num >= FIRST_DATA_ROW:
+                        mirror["index"].upsert(row_num, _index_text(rows[row_num - 1]))
+            while rows and not any(rows[-1]):
+                rows.pop()
+            logger.info("Зеркало листа %s: обновлено строк %s", self._sheet_key(sheet_name), len(dirty))
+        mirror["version"] = version
+        mirror["loaded_at"] = time.monotonic()
+        self._overlay_queued_inserts(sheet_name)
+        return True
+
+    def _read_columns(self, sheet, cols) -> list[list[str]]:
+        """Столбцы cols листа (значения с 1-й строки) одним запросом batch_get."""
+        letters = [self._col_number_to_letter(col) for col in cols]
+        columns = self._call(sheet.batch_get, [f"{letter}1:{letter}" for letter in letters])
+        return [[cells[0] if cells else "" for cells in column] for column in columns]
+
+    def _overlay_queued_inserts(self, sheet_name=None) -> None:
+        """Ещё не записанные вставки из очереди должны быть видны в зеркале сразу."""
+        key = self._sheet_key(sheet_name)
+        for item in self._insert_queue:
+            if item["sheet"] == key:
+                self._mirror_write(sheet_name, item["row"], 3, item["values"])
+
+    def _mirror_write(self, sheet_name, row_num: int, start_col: int, values: list) -> None:
+        """Write-through: переносит в зеркало значения, уже записанные в таблицу."""
+        key = self._sheet_key(sheet_name)
+        width = MIRROR_LAST_COL - MIRROR_FIRST_COL + 1
+        with self._mirror_lock:
+            mirror = self._mirrors.get(key)
+            if not mirror:
+                return
+            rows = mirror["rows"]
+            while len(rows) < row_num:
+                rows.append([""] * width)
+            for offset, value in enumerate(values):
+                idx = start_col + offset - MIRROR_FIRST_COL
+                if 0 <= idx < width:
+                    rows[row_num - 1][idx] = "" if value is None else str(value)
+            if row_num >= FIRST_DATA_ROW:
+                mirror["index"].upsert(row_num, _index_text(rows[row_num - 1]))
+
+    def _task_index(self, sheet_name=None) -> TaskIndex:
+        """Поисковый индекс по строкам листа; обновляется вместе с зеркалом."""
+        with self._mirror_lock:
+            self._mirror_rows(sheet_name)
+            return self._mirrors[self._sheet_key(sheet_name)]["index"]
+
+    def invalidate_cache(self, sheet_name=None) -> None:
+        """Сбрасывает зеркало листа (или всех листов, если sheet_name не указан)."""
+        with self._mirror_lock:
+            if sheet_name:
+                self._mirrors.pop(sheet_name, None)
+            else:
+                self._mirrors.clear()
+
     def get_last_filled_row(self, col: int = 4, sheet_name=None) -> int:
         """
         Возвращает номер последней строки с непустым значением в столбце col (по умолчанию C).
         Нужно для вставки новой задачи в следующую строку: next_row = get_last_filled_row() + 1.
+        Для столбцов B–J ответ берётся из локального зеркала листа.
         """
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
-        values = sheet.col_values(col)
+        if MIRROR_FIRST_COL <= col <= MIRROR_LAST_COL:
+            rows = self._mirror_rows(sheet_name)
+            values = [r[col - MIRROR_FIRST_COL] for r in rows]
+        else:
+            sheet = self._worksheet(sheet_name)
+            values = self._call(sheet.col_values, col)
         for i in range(len(values) - 1, -1, -1):
             v = values[i]
             if v and str(v).strip():
@@ -65,86 +675,284 @@ class Editor:
         Считается, что заголовок в строке 3, данные — с 4-й строки,
         таблица в столбцах 2–9 (8 колонок). Читается диапазон от строки 3
         до последней заполненной строки в столбце C (get_last_filled_row).
+        Данные берутся из локального зеркала листа.
 
         Возвращает список строк: каждая строка — список значений ячеек.
         Первый элемент списка — строка заголовков, остальные — строки данных.
         """
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
         last_row = self.get_last_filled_row(col=3, sheet_name=sheet_name)
         if last_row < 3:
             return []
-        start_letter = self._col_number_to_letter(2)
-        end_letter = self._col_number_to_letter(9)
-        range_name = f"{start_letter}3:{end_letter}{last_row}"
-        return sheet.get(range_name)
+        rows = self._mirror_rows(sheet_name)
+        width = TABLE_LAST_COL - MIRROR_FIRST_COL + 1
+        return [_trim_row(r[:width]) for r in rows[2:last_row]]
     def get_row_info(self, row_num: int, sheet_name=None, ):
         """Возвращает значения одной строки (столбцы B–I) как список списков, как и sheet.get."""
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
-        start_letter = self._col_number_to_letter(2)
-        end_letter = self._col_number_to_letter(9)
-        range_name = f"{start_letter}{row_num}:{end_letter}{row_num}"
-        return sheet.get(range_name)
+        rows = self._mirror_rows(sheet_name)
+        if row_num < 1 or row_num > len(rows):
+            return []
+        width = TABLE_LAST_COL - MIRROR_FIRST_COL + 1
+        row = _trim_row(rows[row_num - 1][:width])
+        return [row] if row else []
     def insert_info(self, task_dict: dict, sheet_name=None) -> int:
         """
         Вставляет задачу из словаря (результат decipher_add_task_command) в таблицу.
         Колонки: Статус, Задача, Категория, Ответственные, Срок, Приоритет, Комментарии/Подзадачи.
         Статус для новых задач всегда 🔄. Пустые значения (None) записываются как пустая ячейка.
         Строка вставки: следующая после последней заполненной в столбце C.
+        Перед выбором строки зеркало сверяется с таблицей (_refresh_mirror), даже если не устарело.
         """
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
-        next_row = self.get_last_filled_row(col=3, sheet_name=sheet_name) + 1
-        row_data = [
-            "🔄",
-            (task_dict.get("task") or ""),
-            (task_dict.get("category") or ""),
-            (task_dict.get("responsible") or ""),
-            datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M"),  # дата/время добавления (распознаётся в Таблице как дата)
-            (task_dict.get("deadline") or ""),
-            (task_dict.get("priority") or ""),
-            (task_dict.get("comments") or ""),
-        ]
+        sheet = self._worksheet(sheet_name)
+        row_data = _task_row_data(task_dict)
+        # Строку резервируем в зеркале под блокировкой, чтобы параллельные вставки не совпали
+        with self._mirror_lock:
+            mirror = self._mirrors.get(self._sheet_key(sheet_name))
+            if mirror:
+                # Строку могли дописать вручную за время cache_ttl — иначе вставка её затрёт
+                mirror["loaded_at"] = 0
+            next_row = self.get_last_filled_row(col=3, sheet_name=sheet_name) + 1
+            self._mirror_write(sheet_name, next_row, 3, row_data)
         start_letter = self._col_number_to_letter(3)
         end_letter = self._col_number_to_letter(10)  # 8 колонок: C..J
         range_name = f"{start_letter}{next_row}:{end_letter}{next_row}"
-        sheet.update(range_name, [row_data])
+        try:
+            self._call(sheet.update, range_name, [row_data])
+        except Exception:
+            self.invalidate_cache(sheet_name)
+            raise
         # Возвращаем номер добавленной строки — удобно для последующей отмены.
         return next_row
-    def update_info(self, search_result: dict, sheet_name=None) -> None:
+
+    def _load_insert_queue(self) -> list[dict]:
+        if not self.queue_path or not os.path.exists(self.queue_path):
+            return []
+        with open(self.queue_path, encoding="utf-8") as f:
+            queue = json.load(f)
+        if queue:
+            logger.info("Восстановлено %s незаписанных задач из %s", len(queue), self.queue_path)
+        return queue
+
+    def _save_insert_queue(self) -> None:
+        """Атомарно сохраняет очередь вставок на диск (вызывается под _mirror_lock)."""
+        if not self.queue_path:
+            return
+        tmp_path = f"{self.queue_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._insert_queue, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.queue_path)
+
+    def _queued_insert(self, sheet_name, row_num: int) -> dict | None:
+        key = self._sheet_key(sheet_name)
+        for item in self._insert_queue:
+            if item["sheet"] == key and item["row"] == row_num:
+                return item
+        return None
+
+    def queue_insert(self, task_dict: dict, sheet_name=None) -> int:
+        """
+        Отложенная вставка задачи: номер строки назначается локально, задача сохраняется
+        в очередь (на диск, если задан queue_path) и сразу видна в зеркале листа.
+        В таблицу очередь записывается методом flush_inserts. Возвращает номер строки;
+        если до записи эту строку займут в таблице вручную, задача будет записана ниже.
+        """
+        row_data = _task_row_data(task_dict)
+        with self._mirror_lock:
+            next_row = self.get_last_filled_row(col=3, sheet_name=sheet_name) + 1
+            self._insert_queue.append(
+                {"sheet": self._sheet_key(sheet_name), "row": next_row, "values": row_data}
+            )
+            self._save_insert_queue()
+            self._mirror_write(sheet_name, next_row, 3, row_data)
+        return next_row
+
+    def pending_inserts(self) -> int:
+        """
+        Сколько задач ждут записи в таблицу. Без _mirror_lock: вызывается из event loop,
+        а блокировку потоки держат на время сетевых запросов.
+        """
+        return len(self._insert_queue)
+
+    def flush_inserts(self) -> int:
+        """
+        Записывает очередь вставок в таблицу: один batch_update на лист,
+        подряд идущие строки объединяются в один диапазон. Перед записью столбец C листа
+        сверяется с таблицей: занятые тем временем строки не затираются (_move_taken_rows).
+        Записанные задачи удаляются из очереди; при ошибке задачи листа остаются в очереди
+        до следующей попытки. Возвращает число записанных строк.
+        """
+        with self._flush_lock:
+            return self._flush_inserts()
+
+    def _flush_inserts(self) -> int:
+        with self._mirror_lock:
+            by_sheet: dict[str, list[dict]] = {}
+            for item in self._insert_queue:
+                by_sheet.setdefault(item["sheet"], []).append(item)
+        written = 0
+        start_letter = self._col_number_to_letter(3)
+        end_letter = self._col_number_to_letter(10)
+        for key, items in by_sheet.items():
+            try:
+                # Лист могли переименовать или удалить — задачи других листов всё равно записываем
+                sheet = self._worksheet(key)
+                # Номера строк выданы по зеркалу, которое могло устареть: сверяем столбец C с таблицей
+                filled = self._read_columns(sheet, (3,))[0]
+                self._move_taken_rows(key, items, {i + 1 for i, v in enumerate(filled) if str(v).strip()})
+            except Exception as e:
+                logger.warning("Не удалось проверить строки очереди на листе «%s»: %s", key, e)
+                continue
+            items.sort(key=lambda item: item["row"])
+            data = []
+            for item in items:
+                if data and data[-1]["end"] == item["row"] - 1:
+                    data[-1]["values"].append(item["values"])
+                    data[-1]["end"] = item["row"]
+                else:
+                    data.append({"start": item["row"], "end": item["row"], "values": [item["values"]]})
+            ranges = [
+                {"range": f"{start_letter}{d['start']}:{end_letter}{d['end']}", "values": d["values"]}
+                for d in data
+            ]
+            try:
+                self._call(sheet.batch_update, ranges)
+            except Exception as e:
+                logger.warning("Не удалось записать очередь задач на лист «%s»: %s", key, e)
+                continue
+            with self._mirror_lock:
+                self._insert_queue = [i for i in self._insert_queue if not any(i is x for x in items)]
+                self._save_insert_queue()
+            written += len(items)
+        return written
+
+    def _move_taken_rows(self, key: str, items: list[dict], filled: set[int]) -> None:
+        """
+        Задачи очереди, чьи строки уже заняты в таблице (например, задачу дописали вручную),
+        переносятся ниже последней занятой строки — и в таблице, и в зеркале, и среди очереди.
+        """
+        with self._mirror_lock:
+            taken = [item for item in items if item["row"] in filled]
+            if not taken:
+                return
+            mirror = self._mirrors.get(key)
+            last_rows = [max(filled)]
+            last_rows += [item["row"] for item in self._insert_queue if item["sheet"] == key]
+            if mirror:
+                last_rows += [i + 1 for i, r in enumerate(mirror["rows"]) if str(r[3 - MIRROR_FIRST_COL]).strip()]
+            next_row = max(last_rows) + 1
+            for item in taken:
+                logger.warning(
+                    "Строка %s листа «%s» занята в таблице, задача из очереди перенесена в строку %s",
+                    item["row"], key, next_row,
+                )
+                self._mirror_write(key, item["row"], 3, [""] * len(item["values"]))
+                item["row"] = next_row
+                self._mirror_write(key, next_row, 3, item["values"])
+                next_row += 1
+            if mirror:
+                # Содержимое занятых строк дочитается при следующем обращении (_refresh_mirror)
+                mirror["loaded_at"] = 0
+            self._save_insert_queue()
+
+    def get_header_map(self, sheet_name=None) -> dict[str, int]:
+        """Название колонки (строка 3, столбцы B–I) -> номер столбца. Берётся из зеркала листа."""
+        rows = self._mirror_rows(sheet_name)
+        if len(rows) < 3:
+            return {}
+        header_map = {}
+        for i, header in enumerate(rows[2][:TABLE_LAST_COL - MIRROR_FIRST_COL + 1]):
+            header = str(header).strip()
+            if header:
+                header_map.setdefault(header, MIRROR_FIRST_COL + i)
+        return header_map
+
+    def update_info(self, search_result: dict | list[dict], sheet_name=None) -> None:
         """
-        Вносит изменения в таблицу по результату search_task_to_update.
-        Берёт только первую подходящую задачу (matched_rows[0]), записывает в неё значения из changes.
-        Если matched_rows пустой или changes пустой — ничего не делает.
+        Вносит изменения в таблицу по результату search_task_to_update (или списку таких результатов).
+        Значения из changes записываются во все строки matched_rows одним запросом batch_update.
+        Результаты без matched_rows или changes пропускаются; если применять нечего — ValueError.
+        Строки выше FIRST_DATA_ROW (заголовок таблицы) не меняются: такой результат — тоже ValueError.
         """
-        matched = search_result.get("matched_rows", [])
-        changes = search_result.get("changes", {})
-        if not matched or not changes:
+        results = [search_result] if isinstance(search_result, dict) else list(search_result)
+        results = [r for r in results if r.get("matched_rows") and r.get("changes")]
+        if not results:
             raise ValueError(
                 "Нет данных для обновления: укажите matched_rows и changes в search_result"
             )
-        row = matched[0]
-        raw = self.scan_table(sheet_name=sheet_name)
-        if not raw:
+        bad_rows = sorted({int(row) for r in results for row in r["matched_rows"] if int(row) < FIRST_DATA_ROW})
+        if bad_rows:
+            raise ValueError(f"Строки {bad_rows} — не строки задач (данные начинаются с {FIRST_DATA_ROW}-й)")
+        header_map = self.get_header_map(sheet_name=sheet_name)
+        if not header_map:
             raise ValueError("Таблица пуста или не удалось прочитать данные листа")
-        headers = [str(h).strip() for h in raw[0]]
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
-        for header_name, value in changes.items():
-            if header_name not in headers:
-                continue
-            col = 2 + headers.index(header_name)
-            sheet.update_cell(row, col, value)
+        # (строка, столбец) -> значение; при повторе ячейки побеждает более позднее изменение
+        cells: dict[tuple[int, int], str] = {}
+        for result in results:
+            for row in result["matched_rows"]:
+                for header_name, value in result["changes"].items():
+                    col = header_map.get(header_name)
+                    if col is None:
+                        continue
+                    cells[(int(row), col)] = value
+        if not cells:
+            return
+        sheet = self._worksheet(sheet_name)
+        with self._flush_lock:
+            # Строки из очереди вставок в таблице ещё пусты: их ячейки правятся только в очереди
+            # и зеркале (_sync_written_cells), иначе flush_inserts сочтёт строку занятой
+            with self._mirror_lock:
+                data = [
+                    {"range": f"{self._col_number_to_letter(col)}{row}", "values": [[value]]}
+                    for (row, col), value in cells.items()
+                    if not self._queued_cell(sheet_name, row, col)
+                ]
+            if data:
+                self._call(sheet.batch_update, data, value_input_option=ValueInputOption.user_entered)
+            self._sync_written_cells(sheet_name, cells)
+
+    def _queued_cell(self, sheet_name, row: int, col: int) -> dict | None:
+        """Задача из очереди вставок, в значения которой (C–J) попадает ячейка (row, col)."""
+        queued = self._queued_insert(sheet_name, row)
+        if queued and 0 <= col - 3 < len(queued["values"]):
+            return queued
+        return None
+
+    def _sync_written_cells(self, sheet_name, cells: dict[tuple[int, int], str]) -> None:
+        with self._mirror_lock:
+            for (row, col), value in cells.items():
+                self._mirror_write(sheet_name, row, col, [value])
+                # Строка ещё в очереди вставок — иначе flush_inserts затрёт изменение
+                queued = self._queued_cell(sheet_name, row, col)
+                if queued:
+                    queued["values"][col - 3] = value
+            self._save_insert_queue()
 
     def delete_row(self, row_num: int, sheet_name=None) -> None:
         """
         Очищает содержимое строки с колонки C по I (включительно).
         Строка не удаляется — колонка B с формулой нумерации остаётся нетронутой.
         Используется для отмены последнего добавления.
+        Если строка ещё в очереди вставок, она просто убирается из очереди.
         """
-        sheet = self.spreadsheet.worksheet(sheet_name) if sheet_name else self.sheet
+        with self._flush_lock:
+            self._delete_row(row_num, sheet_name=sheet_name)
+
+    def _delete_row(self, row_num: int, sheet_name=None) -> None:
+        with self._mirror_lock:
+            queued = self._queued_insert(sheet_name, row_num)
+            if queued:
+                self._insert_queue.remove(queued)
+                self._save_insert_queue()
+                self._mirror_write(sheet_name, row_num, 3, [""] * len(queued["values"]))
+                return
+        sheet = self._worksheet(sheet_name)
         start_letter = self._col_number_to_letter(3)   # C
         end_letter = self._col_number_to_letter(9)     # I
         range_name = f"{start_letter}{row_num}:{end_letter}{row_num}"
         empty_row = [[""] * 7]  # 7 колонок: C, D, E, F, G, H, I
-        sheet.update(range_name, empty_row)
+        self._call(sheet.update, range_name, empty_row)
+        self._mirror_write(sheet_name, row_num, 3, empty_row[0])
 
     @staticmethod
     def decipher_add_task_command(command: str, client: OpenAI) -> dict:
@@ -170,16 +978,11 @@ class Editor:
 
 Ответ — только JSON:"""
 
-        response = client.chat.completions.create(
-            model="openai/gpt-5-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-        )
-        text = response.choices[0].message.content.strip()
-        # Убираем markdown-обёртку если LLM добавил ```json ... ```
-        if text.startswith("```"):
-            text = text.split("```")[1].lstrip("json").strip()
-        return json.loads(text)
+        cache_key = _llm_cache_key("decipher_add_task_command", today, normalize_input(command))
+        data = _ask_llm_json(client, prompt, cache_key, schema=ADD_TASK_SCHEMA)
+        if data.get("deadline"):
+            data["deadline"] = normalize_deadline(data["deadline"])
+        return data
 
     @staticmethod
     def extract_task_from_chat_message(message_text: str, client: OpenAI) -> dict | None:
@@ -205,36 +1008,80 @@ class Editor:
 Если постановка задачи ЕСТЬ — верни JSON с полями:
 {{
   "is_task": true,
-  "task": "Краткое название задачи (1-10 слов), чёткая формулировка.",
-  "responsible": "Имя ответственного в именительном падеже. Если не указано — null.",
-  "deadline": "Дата в формате дд.мм.гггг (относительные формулировки переведи относительно сегодня). Если не указано — null.",
-  "priority": "«высокий», «средний» или «низкий». Если не указано — null.",
-  "comments": "Оставь пустым, только если пользователь напрямую не просит что-то отметить в комментарии",
-  "category": "Категория задачи, если из контекста понятна. Иначе null."
+{CHAT_TASK_FIELDS}
 }}
 
 Ответ — только JSON:"""
 
-        response = client.chat.completions.create(
-            model="openai/gpt-5-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-        )
-        text = response.choices[0].message.content.strip()
-        if text.startswith("```"):
-            text = text.split("```")[1].lstrip("json").strip()
-        data = json.loads(text)
-        if not data.get("is_task"):
-            return None
+        cache_key = _llm_cache_key("extract_task_from_chat_message", today, normalize_input(message_text))
+        data = _ask_llm_json(client, prompt, cache_key, schema=CHAT_TASK_SCHEMA)
         # Приводим к формату insert_info (без is_task)
-        return {
-            "task": data.get("task") or "",
-            "responsible": data.get("responsible"),
-            "deadline": data.get("deadline"),
-            "priority": data.get("priority"),
-            "comments": data.get("comments"),
-            "category": data.get("category"),
-        }
+        return _chat_task_from_llm(data)
+
+    @staticmethod
+    def extract_tasks_from_chat_messages(messages: list[str], client: OpenAI) -> list[dict | None]:
+        """
+        Пакетный вариант extract_task_from_chat_message: несколько сообщений (в том числе из
+        разных чатов) разбираются одним запросом к LLM. Возвращает список той же длины,
+        что и messages: dict для insert_info или None для каждого сообщения.
+        Сообщения, по которым LLM не вернул результат, разбираются по одному.
+        """
+        results: list[dict | None] = [None] * len(messages)
+        today = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y")
+        indexed = []
+        cache_keys = {}
+        response_cache = get_response_cache()
+        for i, m in enumerate(messages):
+            if not m or not m.strip():
+                continue
+            cache_keys[i] = _llm_cache_key("extract_task_from_chat_message", today, normalize_input(m))
+            cached = response_cache.get(cache_keys[i]) if response_cache else None
+            if cached is not None:
+                results[i] = _chat_task_from_llm(cached)
+            else:
+                indexed.append((i, m.strip()))
+        if not indexed:
+            return results
+        if len(indexed) == 1:
+            i, text = indexed[0]
+            results[i] = Editor.extract_task_from_chat_message(text, client)
+            return results
+        messages_json = json.dumps(
+            [{"id": i, "text": text} for i, text in indexed], ensure_ascii=False
+        )
+        prompt = f"""Сегодняшняя дата: {today}
+
+Сообщения из рабочих чатов (каждое со своим id, сообщения не связаны между собой):
+{messages_json}
+
+Для КАЖДОГО сообщения определи: есть ли в нём постановка задачи — то есть кто-то явно или по смыслу поручает другому человеку (или группе) что-то сделать. Обычные обсуждения, вопросы, благодарности, новости без поручения — не задача.
+
+Ответ — ТОЛЬКО JSON-массив без markdown и пояснений, по одному объекту на каждое сообщение, с тем же id.
+
+Если постановки задачи НЕТ — объект: {{"id": 0, "is_task": false}}
+
+Если постановка задачи ЕСТЬ — объект с полями:
+{{
+  "id": 0,
+  "is_task": true,
+{CHAT_TASK_FIELDS}
+}}
+
+Ответ — только JSON-массив:"""
+
+        data = _ask_llm_json(client, prompt, schema=CHAT_TASKS_BATCH_SCHEMA)
+        answered = set()
+        for item in data["results"]:
+            i = item["id"]
+            if i in cache_keys and i not in answered:
+                answered.add(i)
+                results[i] = _chat_task_from_llm(item)
+                if response_cache:
+                    response_cache.put(cache_keys[i], {k: v for k, v in item.items() if k != "id"})
+        for i, text in indexed:
+            if i not in answered:
+                results[i] = Editor.extract_task_from_chat_message(text, client)
+        return results
 
     @staticmethod
     def parse_follow_up_for_deadline(
@@ -245,9 +1092,14 @@ class Editor:
         указал ли он срок, отказался ли от добавления задачи, или ответ неясен.
         Возвращает dict с полем "action": "add" | "decline" | "unclear"
         и при action=="add" — "deadline": "дд.мм.гггг".
+        Типовые ответы («завтра», «25.02», «не добавляй») разбираются локально (deadline_parser),
+        в LLM уходят только неоднозначные.
         """
         if not message_text or not message_text.strip():
             return {"action": "unclear"}
+        local = parse_follow_up(message_text)
+        if local:
+            return local
         today = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y")
         prompt = f"""Сегодняшняя дата: {today}
 
@@ -261,29 +1113,49 @@ class Editor:
 
 Ответ — только один JSON, без markdown и пояснений."""
 
-        response = client.chat.completions.create(
-            model="openai/gpt-5-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
+        cache_key = _llm_cache_key(
+            "parse_follow_up_for_deadline",
+            today,
+            normalize_input(pending_task_formulation),
+            normalize_input(message_text),
         )
-        text = response.choices[0].message.content.strip()
-        if text.startswith("```"):
-            text = text.split("```")[1].lstrip("json").strip()
-        data = json.loads(text)
-        action = (data.get("action") or "unclear").strip().lower()
+        data = _ask_llm_json(client, prompt, cache_key, schema=FOLLOW_UP_SCHEMA)
+        action = data["action"] or "unclear"
         if action == "add":
-            deadline = (data.get("deadline") or "").strip()
+            deadline = normalize_deadline(data.get("deadline"))
             if deadline:
                 return {"action": "add", "deadline": deadline}
         if action == "decline":
             return {"action": "decline"}
         return {"action": "unclear"}
 
-    def search_task_to_update(self, command: str, client: OpenAI, sheet_name=None) -> dict:
+    def table_format_report(self, sheet_name=None) -> dict[str, dict]:
+        """
+        Сравнивает размер всей таблицы листа в разных форматах промпта.
+        Возвращает {формат: {"chars": ..., "tokens": ...}}; tokens — точный подсчёт,
+        если установлен tiktoken, иначе оценка (см. count_tokens).
+        """
+        raw = self.scan_table(sheet_name=sheet_name)
+        if not raw:
+            return {}
+        headers = [str(h).strip() for h in raw[0]]
+        data_rows = [(sheet_row, values) for sheet_row, values in enumerate(raw[1:], start=FIRST_DATA_ROW) if values]
+        report = {}
+        for table_format in TABLE_FORMAT_TITLES:
+            text = format_table_for_llm(headers, data_rows, table_format)
+            report[table_format] = {"chars": len(text), "tokens": count_tokens(text)}
+        return report
+
+    def search_task_to_update(
+        self, command: str, client: OpenAI, sheet_name=None, top_k: int = 30, table_format: str = "jsonl"
+    ) -> dict:
         """
         По описанию пользователя находит подходящие задачи и то, что нужно в них изменить.
+        Если строк в таблице больше top_k, в LLM отправляются только top_k строк,
+        ближайших к запросу по поисковому индексу (TaskIndex). top_k=0 — вся таблица.
+        table_format — как таблица кодируется в промпте (см. format_table_for_llm).
         Возвращает dict:
-          - matched_rows — список номеров строк на листе (sheet_row);
+          - matched_rows — список номеров строк на листе (sheet_row) из тех, что были отправлены в LLM;
           - changes — словарь «название колонки» → новое значение (только колонки из таблицы).
         Если таблица пуста или задача не найдена — matched_rows пустой. Неизвестные ключи в changes отбрасываются.
         """
@@ -291,23 +1163,24 @@ class Editor:
         if not raw or len(raw) < 2:
             return {"matched_rows": []}
         headers = [str(h).strip() for h in raw[0]]
-        rows_for_llm = []
-        for i in range(1, len(raw)):
-            sheet_row = 3 + i
-            row_dict = {"sheet_row": sheet_row}
-            for j, header in enumerate(headers):
-                row_dict[header] = raw[i][j] if j < len(raw[i]) else ""
-            rows_for_llm.append(row_dict)
-        table_json = json.dumps(rows_for_llm, ensure_ascii=False, indent=2)
+        data_rows = [(sheet_row, values) for sheet_row, values in enumerate(raw[1:], start=FIRST_DATA_ROW) if values]
+        if top_k and len(data_rows) > top_k:
+            candidates = set(self._task_index(sheet_name).search(command, top_k))
+            if not candidates:
+                # Ничего похожего не нашлось — показываем последние добавленные задачи
+                candidates = {sheet_row for sheet_row, _ in data_rows[-top_k:]}
+            data_rows = [(sheet_row, values) for sheet_row, values in data_rows if sheet_row in candidates]
+        table_text = format_table_for_llm(headers, data_rows, table_format)
+        table_title = TABLE_FORMAT_TITLES[table_format]
 
         headers_help = ", ".join(headers)
 
         today = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y")
         prompt = f"""Сегодняшняя дата: {today}
         
-Таблица задач (каждая строка с полем sheet_row — номер строки на листе):
+{table_title}
 
-{table_json}
+{table_text}
 
 Колонки таблицы (названия используй точно): {headers_help}
 
@@ -334,23 +1207,17 @@ class Editor:
 {{"matched_rows": [4], "changes": {{"Заголовок": "Изменение"}}, "Ответ в чате": "Перенёс срок по задаче «Название» на 15.02.2025"}}
 Только JSON, без markdown и пояснений."""
 
-        response = client.chat.completions.create(
-            model="openai/gpt-5-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
+        # Таблица входит в ключ: после любого изменения строк ответ запрашивается заново
+        cache_key = _llm_cache_key(
+            "search_task_to_update", today, normalize_input(command), table_format, headers_help, table_text
         )
-        text = response.choices[0].message.content.strip()
-        if text.startswith("```"):
-            text = text.split("```")[1].lstrip("json").strip()
-        data = json.loads(text)
-        matched = data.get("matched_rows", [])
-        if not isinstance(matched, list):
-            matched = [matched] if matched else []
-        changes_raw = data.get("changes", {})
-        if not isinstance(changes_raw, dict):
-            changes_raw = {}
-        changes = {k: str(v) for k, v in changes_raw.items() if k in headers}
-        chat_reply = (data.get("Ответ в чате") or "").strip()
+        data = _ask_llm_json(client, prompt, cache_key, schema=SEARCH_UPDATE_SCHEMA)
+        # Только строки, показанные модели: иначе изменение попадёт в заголовок или чужую строку
+        shown_rows = {sheet_row for sheet_row, _ in data_rows}
+        matched = [row for row in (data["matched_rows"] or []) if row in shown_rows]
+        # null в changes — очистить ячейку
+        changes = {k: v or "" for k, v in (data["changes"] or {}).items() if k in headers}
+        chat_reply = (data["Ответ в чате"] or "").strip()
 
         # Сохраняем исходные значения строки для возможной отмены изменений.
         revert_row = None
@@ -375,17 +1242,25 @@ class Editor:
         }
 
 
-def transcribe_voice(file_path: str, client: OpenAI) -> str:
+def transcribe_voice(audio: str | bytes, client: OpenAI, filename: str = "voice.ogg") -> str:
     """
     Транскрибирует голосовое сообщение в текст через VseGPT (Whisper).
+    audio — путь к файлу или содержимое файла (bytes, без временных файлов на диске).
     Логика совпадает с transcribe.py для тестов вне бота.
     """
-    with open(file_path, "rb") as audio_file:
-        response = client.audio.transcriptions.create(
-            model="stt-openai/whisper-v3-turbo",
+    if isinstance(audio, str):
+        with open(audio, "rb") as audio_file:
+            audio = audio_file.read()
+    with metrics.span("llm.transcribe", model=TRANSCRIBE_MODEL):
+        response = retry_call(
+            client.audio.transcriptions.create,
+            limiter=llm_limiter,
+            breaker=llm_breaker,
+            is_retryable=_is_retryable_llm_error,
+            model=TRANSCRIBE_MODEL,
             response_format="json",
             language="ru",
-            file=audio_file,
+            file=(filename, bytes(audio)),
         )
 
     if hasattr(response, "text"):
@@ -403,7 +1278,7 @@ if __name__ == "__main__":
 
     test_phrase = "Необходимо сегодня связаться с подрядчиком по ремонту и решить вопрос"
     print("Запрос:", test_phrase)
-    result = bot.search_task_to_update(test_phrase, client)
+    result = bot.search_task_to_update(test_phrase, get_client())
     bot.update_info(result)
     print("matched_rows:", result["matched_rows"])
     print("changes:", result["changes"])
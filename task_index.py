@@ -0,0 +1,106 @@
+"""
+Поисковый индекс по строкам таблицы задач.
+
+Нужен, чтобы в search_task_to_update отправлять в LLM не весь лист, а только K строк,
+похожих на запрос пользователя. Ранжирование — BM25 по словам (с грубым стеммингом
+обрезкой окончаний) плюс нечёткое совпадение по символьным триграммам,
+чтобы находить задачи при опечатках и других падежах имён.
+Индекс обновляется построчно (upsert / remove) вместе с зеркалом листа в Editor.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+
+_WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+# Слова длиннее STEM_LEN обрезаются: «отчёта», «отчёту», «отчётом» -> «отчёт»
+STEM_LEN = 5
+# Вес нечёткого совпадения по триграммам относительно BM25
+TRIGRAM_WEIGHT = 2.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _terms(text: str) -> list[str]:
+    words = _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    return [w[:STEM_LEN] for w in words if len(w) > 1]
+
+
+def _trigrams(text: str) -> set[str]:
+    result = set()
+    for word in _WORD_RE.findall((text or "").lower().replace("ё", "е")):
+        padded = f" {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class TaskIndex:
+    """Индекс «номер строки на листе -> текст задачи» с поиском top-K похожих строк."""
+
+    def __init__(self):
+        self._terms: dict[int, Counter] = {}
+        self._lengths: dict[int, int] = {}
+        self._postings: dict[str, set[int]] = defaultdict(set)
+        self._trigrams: dict[int, set[str]] = {}
+        self._trigram_postings: dict[str, set[int]] = defaultdict(set)
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def upsert(self, row: int, text: str) -> None:
+        """Добавляет или обновляет строку. Пустой текст убирает строку из индекса."""
+        self.remove(row)
+        terms = Counter(_terms(text))
+        if not terms:
+            return
+        self._terms[row] = terms
+        self._lengths[row] = sum(terms.values())
+        self._total_length += self._lengths[row]
+        for term in terms:
+            self._postings[term].add(row)
+        grams = _trigrams(text)
+        self._trigrams[row] = grams
+        for gram in grams:
+            self._trigram_postings[gram].add(row)
+
+    def remove(self, row: int) -> None:
+        terms = self._terms.pop(row, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(row)
+        for term in terms:
+            self._postings[term].discard(row)
+            if not self._postings[term]:
+                del self._postings[term]
+        for gram in self._trigrams.pop(row, ()):
+            self._trigram_postings[gram].discard(row)
+            if not self._trigram_postings[gram]:
+                del self._trigram_postings[gram]
+
+    def search(self, query: str, k: int) -> list[int]:
+        """Возвращает до k номеров строк, наиболее похожих на запрос (по убыванию сходства)."""
+        n_docs = len(self._terms)
+        if not n_docs or k <= 0:
+            return []
+        scores: dict[int, float] = defaultdict(float)
+        avg_length = self._total_length / n_docs
+        for term in set(_terms(query)):
+            rows = self._postings.get(term)
+            if not rows:
+                continue
+            idf = math.log(1 + (n_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+            for row in rows:
+                tf = self._terms[row][term]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[row] / avg_length)
+                scores[row] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        query_grams = _trigrams(query)
+        if query_grams:
+            shared: Counter = Counter()
+            for gram in query_grams:
+                for row in self._trigram_postings.get(gram, ()):
+                    shared[row] += 1
+            for row, count in shared.items():
+                union = len(query_grams) + len(self._trigrams[row]) - count
+                scores[row] += TRIGRAM_WEIGHT * count / union
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [row for row, score in ranked[:k] if score > 0]
@@ -0,0 +1,38 @@
+import pytest
+
+from prefilter import TaskPrefilter
+
+TASKS = [
+    "Сделать смету",
+    "Позвонить подрядчику",
+    "Купить цемент",
+    "Петрову сделать смету",
+    "Петров, отчёт",
+    "Привезти плитку на объект",
+    "Разобраться с пропусками",
+    "Иван, подготовь договор",
+    "Проверьте акты до пятницы",
+    "Нужно обновить график",
+    "Смета к 15.03",
+    "@ivanov посмотри чертежи",
+]
+
+NOT_TASKS = [
+    "Спасибо",
+    "Ок",
+    "Спасибо, всё есть",
+    "Доброе утро, коллеги",
+    "👍",
+    "+",
+    "Да, договорились",
+]
+
+
+@pytest.mark.parametrize("text", TASKS)
+def test_task_passes(text):
+    assert TaskPrefilter().check(text).is_candidate
+
+
+@pytest.mark.parametrize("text", NOT_TASKS)
+def test_obvious_non_task_skipped(text):
+    assert not TaskPrefilter().check(text).is_candidate
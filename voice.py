@@ -0,0 +1,139 @@
+"""
+Распознавание голосовых сообщений Telegram (OGG/Opus) без временных файлов.
+
+Длинное сообщение режется по страницам OGG на части примерно по chunk_seconds секунд;
+к каждой части добавляются заголовочные страницы (OpusHead, OpusTags), поэтому каждая
+часть — самостоятельный файл, и части распознаются параллельно. Распознавание идёт
+в отдельном ограниченном пуле потоков, чтобы не занимать пул обработки текстовых сообщений.
+"""
+import asyncio
+import contextvars
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+OGG_CAPTURE = b"OggS"
+OPUS_SAMPLE_RATE = 48000  # granule position в Opus всегда в отсчётах 48 кГц
+_PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+_FLAG_CONTINUED = 0x01
+_FLAG_EOS = 0x04
+
+
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def _ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def _read_pages(data: bytes) -> list[dict] | None:
+    """Страницы OGG: {"flags", "granule", "raw"}; None — если это не OGG."""
+    pages = []
+    offset = 0
+    while offset < len(data):
+        if offset + _PAGE_HEADER.size > len(data):
+            return None
+        capture, _, flags, granule, _, _, _, segments = _PAGE_HEADER.unpack_from(data, offset)
+        if capture != OGG_CAPTURE:
+            return None
+        table_end = offset + _PAGE_HEADER.size + segments
+        end = table_end + sum(data[offset + _PAGE_HEADER.size:table_end])
+        if end > len(data):
+            return None
+        pages.append({"flags": flags, "granule": granule, "raw": data[offset:end]})
+        offset = end
+    return pages
+
+
+def _write_page(page: dict, sequence: int, eos: bool) -> bytes:
+    """Страница с новым номером (и флагом конца потока) и пересчитанной CRC."""
+    raw = bytearray(page["raw"])
+    if eos:
+        raw[5] |= _FLAG_EOS
+    else:
+        raw[5] &= ~_FLAG_EOS & 0xFF
+    struct.pack_into("<I", raw, 18, sequence)
+    struct.pack_into("<I", raw, 22, 0)
+    struct.pack_into("<I", raw, 22, _ogg_crc(raw))
+    return bytes(raw)
+
+
+def split_ogg_opus(data: bytes, chunk_seconds: float = 60) -> list[bytes]:
+    """
+    Делит OGG/Opus на части не короче chunk_seconds секунд (последняя — остаток).
+    Режет только на границах пакетов. Короткие записи и не-OGG возвращаются как есть.
+    """
+    pages = _read_pages(data)
+    if not pages:
+        return [data]
+    # Заголовочные страницы (OpusHead, OpusTags) идут первыми и имеют granule 0
+    header_count = 0
+    while header_count < len(pages) and pages[header_count]["granule"] == 0:
+        header_count += 1
+    headers, audio = pages[:header_count], pages[header_count:]
+    if not audio or audio[-1]["granule"] <= chunk_seconds * OPUS_SAMPLE_RATE * 1.5:
+        return [data]
+
+    groups = []
+    current = []
+    start_granule = 0
+    for i, page in enumerate(audio):
+        current.append(page)
+        next_continues = i + 1 < len(audio) and audio[i + 1]["flags"] & _FLAG_CONTINUED
+        if page["granule"] - start_granule >= chunk_seconds * OPUS_SAMPLE_RATE and not next_continues:
+            groups.append(current)
+            current = []
+            start_granule = page["granule"]
+    if current:
+        # Короткий хвост не выделяем в отдельную часть
+        if groups and current[-1]["granule"] - start_granule < chunk_seconds * OPUS_SAMPLE_RATE / 4:
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    if len(groups) == 1:
+        return [data]
+
+    chunks = []
+    for group in groups:
+        chunk_pages = headers + group
+        chunks.append(b"".join(
+            _write_page(page, sequence, eos=sequence == len(chunk_pages) - 1)
+            for sequence, page in enumerate(chunk_pages)
+        ))
+    return chunks
+
+
+class VoiceTranscriber:
+    def __init__(self, transcribe, max_workers: int = 4, chunk_seconds: float = 60):
+        """
+        transcribe — синхронная функция bytes -> текст (например, script.transcribe_voice с client).
+        max_workers — сколько частей распознаётся одновременно (по всем сообщениям).
+        """
+        self._transcribe = transcribe
+        self.chunk_seconds = chunk_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="voice")
+
+    async def transcribe(self, data: bytes) -> str:
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(self._executor, split_ogg_opus, data, self.chunk_seconds)
+        # Свой контекст на каждую часть: метрики в потоке знают, чьё это сообщение
+        texts = await asyncio.gather(*(
+            loop.run_in_executor(self._executor, contextvars.copy_context().run, self._transcribe, chunk)
+            for chunk in chunks
+        ))
+        return " ".join(text.strip() for text in texts if text and text.strip())
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)